@@ -0,0 +1,145 @@
+# The active file.
+#
+# The active file in the groups directory summarizes the article
+# range of every group, so that LIST and GROUP don't need to scan the
+# group directories.  Each line holds
+#
+#     name high low count stamp
+#
+# where stamp is the modification time of the group's index file when
+# the line was written.  update.py and expire.py rewrite a group's
+# line after they change its articles; if the stamp no longer matches,
+# the line is stale and the group directory is scanned instead.
+#
+# Updating a group's line also bumps the group's generation, which
+# tells servers to drop anything they have cached for the group.
+
+import os, os.path, errno
+
+import settings, lockfile, group
+
+def active_path():
+    return os.path.join(settings.groups_dir, "active")
+
+def group_stamp(name):
+    """Return the stamp identifying the current state of the named
+    group's articles."""
+    # the sqlite store keeps its index in the database, and touches
+    # the stamp file instead
+    for fname in ("index", "stamp"):
+        try:
+            return os.stat(os.path.join(group.group_path(name),
+                                        fname)).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    return 0
+
+def load():
+    """Load the active file, as a dict mapping group names to
+    (lowest, highest, count, stamp) tuples.
+
+    Returns None if there is no active file."""
+    try:
+        f = file(active_path())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    entries = {}
+    try:
+        for l in f:
+            fields = l.split()
+            if len(fields) != 5:
+                continue
+
+            (name, highest, lowest, count, stamp) = fields
+            entries[name] = (int(lowest), int(highest), int(count),
+                             float(stamp))
+    finally:
+        f.close()
+
+    return entries
+
+def lookup(name, entries):
+    """Return the (lowest, highest, count) triple for the named group
+    from the loaded active entries, or None if it is missing or
+    stale."""
+    if entries is None or name not in entries:
+        return None
+
+    (lowest, highest, count, stamp) = entries[name]
+    if stamp != group_stamp(name):
+        return None
+
+    return (lowest, highest, count)
+
+def article_range(g, entries=None):
+    """Determine a (lowest article number, highest article number,
+    article count) triple for the group, using the active file if it
+    is up to date."""
+    if entries is None:
+        entries = load()
+
+    res = lookup(g.name, entries)
+    if res is None:
+        res = g.article_range()
+
+    return res
+
+def write(entries):
+    path = active_path()
+    tmppath = path + ".new"
+    f = file(tmppath, "w")
+    try:
+        for name in sorted(entries):
+            (lowest, highest, count, stamp) = entries[name]
+            f.write("%s %d %d %d %r\n" % (name, highest, lowest, count, stamp))
+    finally:
+        f.close()
+
+    os.rename(tmppath, path)
+
+def modify(func):
+    """Apply func to the active entries, and atomically replace the
+    active file with the result."""
+    lock = lockfile.LockFile(os.path.join(settings.groups_dir, "active.lock"))
+    lock.lock(poll_interval=0.1)
+    try:
+        entries = load() or {}
+        func(entries)
+        write(entries)
+    finally:
+        lock.unlock()
+
+def update(g):
+    """Bring the active file line for a group up to date, and bump
+    the group's generation.
+
+    The caller should hold the group's lock."""
+    g.bump_generation()
+
+    def f(entries):
+        stamp = group_stamp(g.name)
+        entries[g.name] = g.article_range() + (stamp,)
+
+    modify(f)
+
+def remove(name):
+    """Remove the active file line for a group."""
+    def f(entries):
+        entries.pop(name, None)
+
+    modify(f)
+
+def rebuild():
+    """Rebuild the active file from scratch."""
+    def f(entries):
+        entries.clear()
+        for g in group.groups():
+            stamp = group_stamp(g.name)
+            entries[g.name] = g.article_range() + (stamp,)
+
+    modify(f)
@@ -6,11 +6,15 @@
 import sys, time, optparse, settings, update
 from HTMLParser import HTMLParser
 
-import group, english
+import group, english, active, msgid
 
 props = [('href', 'Feed URI'),
          ('link', 'Feed homepage URI'),
          ('interval', 'Poll interval', english.describe_interval),
+         ('adaptive', 'Adaptive polling', lambda a: a and 'yes' or 'no'),
+         ('spool', 'Spooled renderings', lambda a: a and 'yes' or 'no'),
+         ('learned_interval', 'Learned poll interval',
+          english.describe_interval),
          ('lastpolled', 'Last successful poll time',
           lambda s: time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s))),
          ('article_lifetime', 'Article lifetime', english.describe_interval)]
@@ -105,6 +109,18 @@ parser.add_option('-d', '--delete-group', action='store_true')
 parser.add_option('-u', '--uri')
 parser.add_option('-l', '--article-lifetime')
 parser.add_option('-i', '--poll-interval')
+parser.add_option('--adaptive', action='store_true', dest='adaptive',
+                  help="learn the poll interval from the feed")
+parser.add_option('--no-adaptive', action='store_false', dest='adaptive',
+                  help="always use the configured poll interval")
+parser.add_option('--debug-dump', action='store_true', dest='debug_dump',
+                  help="save each parsed feed, for debugging")
+parser.add_option('--no-debug-dump', action='store_false', dest='debug_dump',
+                  help="only save feeds that fail to parse")
+parser.add_option('--spool', action='store_true', dest='spool',
+                  help="save wire-ready renderings of articles")
+parser.add_option('--no-spool', action='store_false', dest='spool',
+                  help="render articles when they are requested")
 (opts, args) = parser.parse_args()
 
 config = {}
@@ -114,6 +130,15 @@ if opts.article_lifetime:
 if opts.poll_interval:
     config['interval'] = english.parse_interval(opts.poll_interval)
 
+if opts.adaptive is not None:
+    config['adaptive'] = opts.adaptive
+
+if opts.debug_dump is not None:
+    config['debug_dump'] = opts.debug_dump
+
+if opts.spool is not None:
+    config['spool'] = opts.spool
+
 if opts.uri:
     if len(args) != 1:
         error("There should be exactly one group name")
@@ -129,6 +154,7 @@ if opts.uri:
                 g.save_config()
                 failed = False
                 g.create()
+                active.update(g)
             finally:
                 if failed:
                     g.delete()
@@ -139,6 +165,7 @@ if opts.uri:
                 g.config.update(config)
                 update.update_group_from_feed(g, feed)
                 g.save_config()
+                active.update(g)
             finally:
                 g.lockfile.unlock()
     else:
@@ -150,6 +177,8 @@ elif opts.delete_group:
     for arg in args:
         g = group.Group(arg)
         g.delete()
+        active.remove(arg)
+        msgid.replace_group(arg, {})
 elif config:
     # update groups
     for arg in args:
@@ -158,6 +187,7 @@ elif config:
         try:
             g.config.update(config)
             g.save_config()
+            g.bump_generation()
         finally:
             g.lockfile.unlock()
 elif len(args) == 0:
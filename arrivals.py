@@ -0,0 +1,166 @@
+# The arrival log.
+#
+# The arrivals file in the groups directory records when articles and
+# groups appeared, for the NEWNEWS and NEWGROUPS commands.  It is
+# appended to as they arrive, with lines
+#
+#     time article group-name article-number message-id
+#     time group group-name
+#
+# so it is in time order, and the entries since a given time can be
+# found by binary search.  expire.py drops old article entries.
+
+import os, os.path, time, mmap, errno
+
+import settings, lockfile
+
+# Writers racing to append may leave entries out of order by a moment;
+# searches start this many seconds early to be sure of seeing them.
+slack = 60
+
+def log_path():
+    return os.path.join(settings.groups_dir, "arrivals")
+
+def log_lock():
+    return lockfile.LockFile(os.path.join(settings.groups_dir,
+                                          "arrivals.lock"))
+
+def append(entries):
+    """Append entries, stamped with the current time, to the log."""
+    lock = log_lock()
+    lock.lock(poll_interval=0.1)
+    try:
+        t = int(time.time())
+        data = ''.join('%d %s\n' % (t, e) for e in entries)
+        fd = os.open(log_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0666)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+    finally:
+        lock.unlock()
+
+def log_articles(group_name, nums):
+    """Record the arrival of articles in a group.  nums maps their
+    message-ids to their article numbers."""
+    if nums:
+        append(['article %s %d %s' % (group_name, num, msgid)
+                for (num, msgid) in sorted((num, msgid) for (msgid, num)
+                                           in nums.iteritems())])
+
+def log_group(name):
+    """Record the creation of a group."""
+    append(['group ' + name])
+
+def find(m, t):
+    """Return the offset of the first line in the mapped log with a
+    time not before t."""
+    lo = 0
+    hi = len(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = m.rfind('\n', 0, mid) + 1
+        end = m.find('\n', start)
+        if end < 0:
+            end = len(m)
+
+        if int(m[start:m.find(' ', start)]) < t:
+            lo = end + 1
+        else:
+            hi = start
+
+    return lo
+
+def entries_since(t):
+    """Return the log entries from time t on, as lists of fields
+    following the time."""
+    try:
+        f = file(log_path())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            m.seek(find(m, t - slack))
+            res = []
+            for l in iter(m.readline, ''):
+                if not l.endswith('\n'):
+                    # still being written
+                    break
+
+                fields = l.split()
+                if int(fields[0]) >= t:
+                    res.append(fields[1:])
+            return res
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def unique(seq):
+    """Return the distinct items of a sequence, in order."""
+    seen = set()
+    res = []
+    for x in seq:
+        if x not in seen:
+            seen.add(x)
+            res.append(x)
+    return res
+
+def new_articles(t):
+    """Return (group name, message-id) pairs for the articles that
+    arrived from time t on."""
+    return unique((e[1], e[3]) for e in entries_since(t)
+                  if e[0] == 'article')
+
+def new_groups(t):
+    """Return the names of the groups created from time t on."""
+    return unique(e[1] for e in entries_since(t) if e[0] == 'group')
+
+def prune(before):
+    """Drop the entries for articles that arrived before the given
+    time.  Entries for groups are kept."""
+    lock = log_lock()
+    lock.lock(poll_interval=0.1)
+    try:
+        try:
+            f = file(log_path())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+
+        kept = []
+        for l in lines:
+            fields = l.split(None, 2)
+            if fields[1] == 'group' or int(fields[0]) >= before:
+                kept.append(l)
+
+        if len(kept) == len(lines):
+            return
+
+        path = log_path()
+        tmppath = path + ".new"
+        f = file(tmppath, "w")
+        try:
+            f.writelines(kept)
+        finally:
+            f.close()
+
+        os.rename(tmppath, path)
+    finally:
+        lock.unlock()
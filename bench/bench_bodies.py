@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Mimics a newsreader prefetching article bodies: it enters a group
+# and pipelines a BODY command for each of the first 500 articles
+# (optionally preceded by a HEAD for each).  Compares dispatching
+# each command separately, flushing after each response, with
+# dispatching the pipelined commands in batches.
+#
+# Usage: bench_bodies.py [-n bodies] [-r repeats] [--heads] [--spool]
+
+import optparse
+
+import benchutil
+
+def make_unbatched(nntp):
+    class UnbatchedServer(nntp.NNTPServer):
+        """NNTPServer as it used to be: every command is dispatched
+        on its own and its response flushed."""
+
+        def process_commands(self):
+            self.writeline(self.greeting)
+            self.output.flush()
+            while True:
+                l = self.input.readline()
+                if l is None:
+                    break
+
+                self.dispatch(l)
+                self.output.flush()
+                if self.finished:
+                    break
+
+    return UnbatchedServer
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--bodies', type='int', default=500)
+    parser.add_option('-r', '--repeats', type='int', default=5)
+    parser.add_option('--heads', action='store_true',
+                      help="send a HEAD before each BODY")
+    parser.add_option('--spool', action='store_true',
+                      help="serve spooled renderings of the articles")
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+    g = benchutil.make_group('bench.bodies', opts.bodies, [500, 2000, 8000])
+    if opts.spool:
+        g.config['spool'] = True
+        g.save_config()
+        for art in g.articles():
+            g.spool_article(art)
+
+    commands = ['MODE READER', 'GROUP bench.bodies']
+    for n in range(1, opts.bodies + 1):
+        if opts.heads:
+            commands.append('HEAD %d' % n)
+        commands.append('BODY %d' % n)
+    commands.append('QUIT')
+
+    for (label, server_class) in (('per command (before)', make_unbatched(nntp)),
+                                  ('batched (after)', nntp.NNTPServer)):
+        best = None
+        for i in range(opts.repeats):
+            res = benchutil.run_session(server_class, commands)
+            if best is None or res[0] < best[0]:
+                best = res
+
+        (elapsed, nbytes, calls, cpu) = best
+        print label
+        benchutil.report("  commands", len(commands))
+        benchutil.report("  elapsed", "%.3f" % elapsed, "s")
+        benchutil.report("  commands/sec", "%.0f" % (len(commands) / elapsed))
+        if calls:
+            benchutil.report("  write syscalls", calls[1])
+        benchutil.report("  response bytes", nbytes)
+
+if __name__ == "__main__":
+    main()
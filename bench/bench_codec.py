@@ -0,0 +1,60 @@
+#!/usr/bin/python
+#
+# Compares the storage codecs: encoded size, and the time to decode an
+# article entry, both from memory and by loading an article from a
+# group directory.
+#
+# Usage: bench_codec.py [-n articles] [-r repeats]
+
+import time, optparse
+
+import benchutil
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=2000)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import settings, group, codec
+
+    # a corpus of entries with a realistic spread of body sizes
+    sizes = [300, 1000, 3000, 10000, 30000]
+    entries = [benchutil.make_entry(i, sizes[i % len(sizes)])
+               for i in range(opts.articles)]
+
+    for name in ('repr', 'marshal'):
+        encoded = [codec.dumps(e, name) for e in entries]
+
+        best = None
+        for i in range(opts.repeats):
+            start = time.time()
+            for data in encoded:
+                codec.loads(data)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        settings.storage_codec = name
+        g = benchutil.make_group('bench.codec.' + name, opts.articles, sizes)
+        nums = list(g.article_numbers())
+        best_load = None
+        for i in range(opts.repeats):
+            start = time.time()
+            for n in nums:
+                g.article(n)
+            elapsed = time.time() - start
+            if best_load is None or elapsed < best_load:
+                best_load = elapsed
+
+        print name
+        benchutil.report("  mean encoded size",
+                         sum(len(d) for d in encoded) // len(encoded), "bytes")
+        benchutil.report("  decode per article",
+                         "%.1f" % (best * 1e6 / len(encoded)), "us")
+        benchutil.report("  load per article (from file)",
+                         "%.1f" % (best_load * 1e6 / len(nums)), "us")
+
+if __name__ == "__main__":
+    main()
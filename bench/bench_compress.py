@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# Measures the bytes sent over the wire and the server CPU time for a
+# typical newsreader session (XOVER of a group, then ARTICLE for some
+# of its articles), with and without COMPRESS DEFLATE.
+#
+# Usage: bench_compress.py [-n articles] [-a fetched] [-r repeats]
+
+import optparse
+
+import benchutil
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=2000)
+    parser.add_option('-a', '--fetched', type='int', default=200)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+    benchutil.make_group('bench.compress', opts.articles, [500, 2000, 8000])
+
+    commands = ['GROUP bench.compress', 'XOVER 1-']
+    step = max(opts.articles // opts.fetched, 1)
+    for n in range(1, opts.articles + 1, step)[:opts.fetched]:
+        commands.append('ARTICLE %d' % n)
+    commands.append('QUIT')
+
+    plain = None
+    for (label, compress) in (('uncompressed', False),
+                              ('COMPRESS DEFLATE', True)):
+        best = None
+        for i in range(opts.repeats):
+            res = benchutil.run_session(nntp.NNTPServer, commands, compress)
+            if best is None or res[3] < best[3]:
+                best = res
+
+        (elapsed, wire, calls, cpu) = best
+        if plain is None:
+            # the responses are the same, bar the COMPRESS exchange
+            plain = wire
+        print label
+        benchutil.report("  response bytes", plain)
+        benchutil.report("  bytes on the wire", wire)
+        benchutil.report("  ratio", "%.2f" % (float(wire) / plain))
+        benchutil.report("  elapsed", "%.3f" % elapsed, "s")
+        benchutil.report("  server CPU per MB", "%.1f"
+                         % (cpu * 1000 / (plain / 1e6)), "ms")
+
+if __name__ == "__main__":
+    main()
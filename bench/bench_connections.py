@@ -0,0 +1,137 @@
+#!/usr/bin/python
+#
+# Measures how nntpasync.py copes with many concurrent connections:
+# it holds a large number of idle connections open while a smaller
+# number of active clients issue commands as fast as they can.
+#
+# Usage: bench_connections.py [-i idle] [-a active] [-d seconds]
+#                             [-n articles]
+#
+# The server runs in a subprocess, so that its memory use can be
+# measured separately from the load generator's.
+
+import os, sys, socket, subprocess, threading, time, optparse, random
+
+import benchutil
+
+def rss_kb(pid):
+    """The resident set size of a process, in kB."""
+    f = open('/proc/%d/status' % pid)
+    try:
+        for l in f:
+            if l.startswith('VmRSS:'):
+                return int(l.split()[1])
+    finally:
+        f.close()
+
+def connect(port):
+    """Open a connection to the server, and read the greeting."""
+    s = socket.create_connection(('127.0.0.1', port))
+    f = s.makefile('r')
+    if not f.readline().startswith('201'):
+        raise Exception("bad greeting")
+    return (s, f)
+
+def read_response(f):
+    """Read a response, including any multi-line part."""
+    status = f.readline()
+    if status[:3] in ('215', '220', '221', '222', '224'):
+        while f.readline() != '.\r\n':
+            pass
+    return status
+
+def active_client(port, group_name, articles, deadline, latencies):
+    (s, f) = connect(port)
+    s.sendall('GROUP %s\r\n' % group_name)
+    read_response(f)
+    rand = random.Random()
+    while time.time() < deadline:
+        n = rand.randint(1, articles)
+        if rand.random() < 0.5:
+            cmd = 'ARTICLE %d\r\n' % n
+        else:
+            cmd = 'XOVER %d-%d\r\n' % (n, n + 20)
+        start = time.time()
+        s.sendall(cmd)
+        read_response(f)
+        latencies.append(time.time() - start)
+
+    s.sendall('QUIT\r\n')
+    f.readline()
+    s.close()
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            return connect(port)
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("server did not start")
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-i', '--idle', type='int', default=1000)
+    parser.add_option('-a', '--active', type='int', default=50)
+    parser.add_option('-d', '--duration', type='float', default=10)
+    parser.add_option('-n', '--articles', type='int', default=1000)
+    parser.add_option('-p', '--port', type='int', default=4329)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    benchutil.make_group('bench.connections', opts.articles)
+
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(benchutil.repo_dir,
+                                            'nntpasync.py'),
+                               '-p', str(opts.port)])
+    try:
+        (probe, probe_f) = wait_for_server(opts.port)
+        base_rss = rss_kb(server.pid)
+
+        idle = [connect(opts.port) for i in range(opts.idle)]
+        idle_rss = rss_kb(server.pid)
+
+        latencies = []
+        deadline = time.time() + opts.duration
+        ts = [threading.Thread(target=active_client,
+                               args=(opts.port, 'bench.connections',
+                                     opts.articles, deadline, latencies))
+              for i in range(opts.active)]
+        start = time.time()
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        elapsed = time.time() - start
+
+        # the idle connections should still be served
+        alive = 0
+        for (s, f) in idle:
+            s.sendall('MODE READER\r\n')
+            if f.readline().startswith('201'):
+                alive += 1
+            s.close()
+
+        latencies.sort()
+        benchutil.report("idle connections", opts.idle)
+        benchutil.report("active connections", opts.active)
+        benchutil.report("commands/sec", "%.0f" % (len(latencies) / elapsed))
+        if latencies:
+            benchutil.report("median latency", "%.2f"
+                             % (latencies[len(latencies) // 2] * 1000), "ms")
+            benchutil.report("99th percentile latency", "%.2f"
+                             % (latencies[len(latencies) * 99 // 100] * 1000),
+                             "ms")
+        benchutil.report("server RSS before", base_rss, "kB")
+        benchutil.report("server RSS with idle connections", idle_rss, "kB")
+        if opts.idle:
+            benchutil.report("RSS per idle connection", "%.1f"
+                             % (float(idle_rss - base_rss) / opts.idle), "kB")
+        benchutil.report("idle connections still served", alive)
+        probe.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Compares the ways of compressing stored article entries: the space
+# they take on disk (which is what must stay in the page cache for
+# articles to be served without disk reads), and the time to load an
+# article.  With the files store, each entry takes at least a block
+# however well it compresses, so packed stores are measured too.
+#
+# Usage: bench_entries.py [-n articles] [-r repeats] [-s stores]
+
+import os, time, optparse
+
+import benchutil
+
+def allocated_space(g):
+    """Return the disk space allocated to a group's articles."""
+    if g.store.name == 'files':
+        paths = [g.group_file(str(n)) for n in g.article_numbers()]
+    elif g.store.name == 'segments':
+        paths = [g.store.path(seg) for seg in g.store.segments()]
+    else:
+        paths = [g.store.path() + suffix for suffix in ("", "-wal")]
+
+    allocated = 0
+    for path in paths:
+        if os.path.exists(path):
+            allocated += os.stat(path).st_blocks * 512
+
+    return allocated
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=2000)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    parser.add_option('-s', '--stores', default="files,segments",
+                      help="comma-separated kinds of store")
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import settings, group, storage
+
+    # a realistic spread of body sizes, mostly small
+    sizes = [300, 500, 1000, 2000, 5000]
+
+    for store in opts.stores.split(','):
+        for method in (None, 'zlib', 'zlib-dict'):
+            settings.article_compression = method
+            name = 'bench.entries.%s.%s' % (store, method or 'none')
+            if method != 'zlib-dict':
+                benchutil.make_group(name, opts.articles, sizes, store)
+            else:
+                # as migrate.py -t -s does.  The entries are rewritten
+                # as files, so that the space they took before is not
+                # counted.
+                g = benchutil.make_group(name, opts.articles, sizes, 'files')
+                g.train_dictionary()
+                for n in g.article_numbers():
+                    g.save_article(n, g.article(n).entry)
+
+                new = storage.stores[store](g)
+                for n in g.article_numbers():
+                    new.save(n, g.store.load(n))
+                if store != 'files':
+                    g.store.remove_all()
+                g.config["storage"] = store
+                g.save_config()
+
+            g = group.Group(name)
+            nums = sorted(g.article_numbers())
+            best = None
+            for i in range(opts.repeats):
+                start = time.time()
+                for n in nums:
+                    g.article(n)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            size = sum(len(g.store.load(n)) for n in nums)
+            print "%s store, %s compression" % (store, method or 'no')
+            benchutil.report("  mean entry size", size // len(nums), "bytes")
+            benchutil.report("  disk space allocated",
+                             allocated_space(g) // 1024, "KB")
+            benchutil.report("  load per article",
+                             "%.1f" % (best * 1e6 / len(nums)), "us")
+
+if __name__ == "__main__":
+    main()
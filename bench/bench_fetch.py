@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# Measures feed fetching throughput against local stand-in HTTP
+# servers, with and without persistent connection reuse.
+#
+# Usage: bench_fetch.py [-f feeds] [-s hosts] [-t threads] [--parse]
+#                       [--conditional]
+#
+# Each stand-in server plays one host, serving many small feeds over
+# HTTP/1.1 with keep-alive and ETags.
+
+import time, threading, optparse, Queue, hashlib
+import BaseHTTPServer, SocketServer
+
+import benchutil
+
+def feed_body(n, items=20):
+    res = ['<?xml version="1.0" encoding="utf-8"?>'
+           '<rss version="2.0"><channel><title>Feed %d</title>'
+           '<link>http://example.com/%d/</link><description>x</description>'
+           % (n, n)]
+    for i in range(items):
+        res.append('<item><title>Item %d</title><guid>http://example.com/%d/%d'
+                   '</guid><description>%s</description></item>'
+                   % (i, n, i, benchutil.filler.replace('<', '&lt;')))
+    res.append('</channel></rss>')
+    return ''.join(res)
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the response is written in several pieces
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        n = int(self.path.split('/')[-1])
+        body = self.server.feeds[n % len(self.server.feeds)]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, feeds):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FeedHandler)
+        self.feeds = feeds
+        self.lock = threading.Lock()
+        self.connections = 0
+
+def run(fetch, feedparser, urls, threads, pool, parse, etags):
+    tasks = Queue.Queue()
+    for url in urls:
+        tasks.put(url)
+
+    def worker():
+        while True:
+            try:
+                url = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            resp = fetch.fetch(url, etag=etags.get(url), pool=pool)
+            etags[url] = resp.headers.get('etag')
+            if parse:
+                feedparser.parse(resp)
+
+    ts = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return time.time() - start
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-f', '--feeds', type='int', default=2000)
+    parser.add_option('-s', '--hosts', type='int', default=4)
+    parser.add_option('-t', '--threads', type='int', default=8)
+    parser.add_option('--parse', action='store_true',
+                      help="parse each feed as well as fetching it")
+    parser.add_option('--conditional', action='store_true',
+                      help="fetch every feed once first, so that the "
+                      "timed fetches send ETags and get 304s")
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import fetch, feedparser
+
+    feeds = [feed_body(n) for n in range(50)]
+    servers = []
+    for i in range(opts.hosts):
+        s = FeedServer(feeds)
+        t = threading.Thread(target=s.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(s)
+
+    urls = ['http://127.0.0.1:%d/feeds/%d'
+            % (servers[n % len(servers)].server_address[1], n)
+            for n in range(opts.feeds)]
+
+    for (label, max_idle) in (('new connection per feed', 0),
+                              ('pooled keep-alive connections', opts.threads)):
+        pool = fetch.ConnectionPool(max_idle_per_host=max_idle)
+        etags = {}
+        if opts.conditional:
+            run(fetch, feedparser, urls, opts.threads, pool, False, etags)
+
+        before = sum(s.connections for s in servers)
+        elapsed = run(fetch, feedparser, urls, opts.threads, pool,
+                      opts.parse, etags)
+        connections = sum(s.connections for s in servers) - before
+        pool.close()
+
+        print label
+        benchutil.report("  feeds", len(urls))
+        benchutil.report("  feeds/sec", "%.0f" % (len(urls) / elapsed))
+        benchutil.report("  connections opened", connections)
+
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+if __name__ == "__main__":
+    main()
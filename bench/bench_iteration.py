@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+# Measures the peak memory used to go through every article of a large
+# group: building its overview, and serving XOVER for the whole range
+# from an overview held by the store.  Each is compared with the old
+# way of first loading the whole range into a list.  Every measurement
+# runs in a fresh process, since peak memory can only grow.
+#
+# Usage: bench_iteration.py [-n articles] [-s stores]
+
+import os, sys, time, resource, subprocess, optparse
+
+import benchutil
+
+def peak_rss():
+    """Return the peak resident set size of this process, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def build_list(g):
+    import overview
+    arts = [g.article(n) for n in sorted(g.article_numbers())]
+    return len([overview.overview_line(art) for art in arts])
+
+def build_lazy(g):
+    import overview
+    return len(overview.build(g).lines)
+
+class ListedOverview:
+    """Collects the overview lines before they are written, as OVER
+    used to."""
+
+    def __init__(self, ov):
+        self.ov = ov
+
+    def lines_in(self, lo=None, hi=None):
+        return list(self.ov.lines_in(lo, hi))
+
+def xover(g, listed):
+    import nntp
+    def server(input, output):
+        server = nntp.NNTPServer(input=input, output=output)
+        if listed:
+            overview_of = server.cache.overview
+            server.cache.overview = lambda g: ListedOverview(overview_of(g))
+        return server
+
+    (elapsed, nbytes, calls, cpu) = benchutil.run_session(
+        server, ['GROUP %s' % g.name, 'XOVER 1-', 'QUIT'])
+    return elapsed
+
+def timed(f):
+    """Wrap a task to return the time it took."""
+    def task(g):
+        start = time.time()
+        f(g)
+        return time.time() - start
+    return task
+
+tasks = {
+    'build-list': timed(build_list),
+    'build-lazy': timed(build_lazy),
+    'xover-list': lambda g: xover(g, True),
+    'xover-lazy': lambda g: xover(g, False),
+}
+
+def child(task, name):
+    """Run a task in this process, and print the peak memory it took."""
+    if benchutil.repo_dir not in sys.path:
+        sys.path.insert(0, benchutil.repo_dir)
+    import group
+    g = group.Group(name)
+    before = peak_rss()
+    elapsed = tasks[task](g)
+    print "%d %f" % (peak_rss() - before, elapsed)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=20000)
+    parser.add_option('-s', '--stores', default="files,sqlite",
+                      help="comma-separated kinds of store")
+    parser.add_option('--child', nargs=2, help=optparse.SUPPRESS_HELP)
+    (opts, args) = parser.parse_args()
+
+    if opts.child:
+        child(*opts.child)
+        return
+
+    benchutil.setup()
+    for store in opts.stores.split(','):
+        name = 'bench.iteration.' + store
+        benchutil.make_group(name, opts.articles, [500, 2000, 8000], store)
+
+        print "%s store, %d articles" % (store, opts.articles)
+        for (label, task) in (('overview build, list (before)', 'build-list'),
+                              ('overview build, lazy (after)', 'build-lazy'),
+                              ('XOVER 1-, list (before)', 'xover-list'),
+                              ('XOVER 1-, lazy (after)', 'xover-lazy')):
+            out = subprocess.check_output([sys.executable,
+                                           os.path.abspath(__file__),
+                                           '--child', task, name])
+            (growth, elapsed) = out.split()
+            benchutil.report("  " + label, "%s KB" % growth,
+                             "%.2f s" % float(elapsed))
+
+if __name__ == "__main__":
+    main()
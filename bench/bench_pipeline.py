@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# Replays a pipelined NNTP session against NNTPServer and reports the
+# read/write system calls made and the command throughput, both with
+# the old unbuffered line reader and with the current one.
+#
+# Usage: bench_pipeline.py [-n articles] [-r repeats] [session-file]
+#
+# A session file contains one client command per line.  Without one, a
+# session resembling a newsreader entering a group and checking every
+# article is generated.
+
+import os, optparse
+
+import benchutil
+
+class UnbufferedLineReader:
+    """The line reader NNTPServer used to have: an unbuffered file
+    object, so one read(2) per byte."""
+
+    def __init__(self, input):
+        self.input = os.fdopen(os.dup(input.fileno()), "rU", 0)
+
+    def pending(self):
+        return False
+
+    def readline(self):
+        l = self.input.readline()
+        if not l:
+            return None
+        if l[-1] == '\n':
+            l = l[0:-1]
+        return l
+
+def run_session(nntp, commands, unbuffered):
+    def server(input, output):
+        server = nntp.NNTPServer(input=input, output=output)
+        if unbuffered:
+            server.input = UnbufferedLineReader(input)
+        return server
+
+    return benchutil.run_session(server, commands)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=500)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+    benchutil.make_group('bench.pipeline', opts.articles)
+
+    if args:
+        f = open(args[0])
+        commands = [l.rstrip('\r\n') for l in f if l.strip()]
+        f.close()
+    else:
+        commands = ['MODE READER', 'GROUP bench.pipeline']
+        for n in range(1, opts.articles + 1):
+            commands.append('STAT %d' % n)
+
+    if not commands or commands[-1].upper() != 'QUIT':
+        commands.append('QUIT')
+
+    for (label, unbuffered) in (('unbuffered (before)', True),
+                                ('buffered (after)', False)):
+        best = None
+        for i in range(opts.repeats):
+            res = run_session(nntp, commands, unbuffered)
+            if best is None or res[0] < best[0]:
+                best = res
+
+        (elapsed, nbytes, calls, cpu) = best
+        print label
+        benchutil.report("  commands", len(commands))
+        benchutil.report("  commands/sec", "%.0f" % (len(commands) / elapsed))
+        if calls:
+            benchutil.report("  read syscalls", calls[0])
+            benchutil.report("  write syscalls", calls[1])
+        benchutil.report("  response bytes", nbytes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# Measures the cost of serving ARTICLE commands, comparing articles
+# rendered on each request with articles sent from their spooled
+# wire-ready renderings.
+#
+# Usage: bench_spool.py [-n articles] [-s body size] [-r repeats]
+
+import optparse
+
+import benchutil
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=2000)
+    parser.add_option('-s', '--body-size', type='int', default=4000)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+    g = benchutil.make_group('bench.spool', opts.articles, opts.body_size)
+
+    commands = ['GROUP bench.spool']
+    commands.extend('ARTICLE %d' % n for n in range(1, opts.articles + 1))
+    commands.append('QUIT')
+
+    for (label, spool) in (('rendered per request (before)', False),
+                           ('spooled renderings (after)', True)):
+        if spool:
+            g.config['spool'] = True
+            g.save_config()
+            for art in g.articles():
+                g.spool_article(art)
+
+        best = None
+        for i in range(opts.repeats):
+            res = benchutil.run_session(nntp.NNTPServer, commands)
+            if best is None or res[3] < best[3]:
+                best = res
+
+        (elapsed, nbytes, calls, cpu) = best
+        print label
+        benchutil.report("  articles", opts.articles)
+        benchutil.report("  articles/sec", "%.0f" % (opts.articles / elapsed))
+        benchutil.report("  server CPU per article", "%.1f"
+                         % (cpu * 1e6 / opts.articles), "us")
+        benchutil.report("  response bytes", nbytes)
+        benchutil.report("  sendfile", nntp.sendfile is not None and "yes"
+                         or "no (read/write fallback)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Compares the latency of LIST, GROUP, XOVER and ARTICLE commands with
+# each kind of article store (see storage.py), for groups of several
+# sizes.  The server is run without a cache, and there is no active
+# file, so that every command goes to the store.  LIST is limited to
+# the group being measured.
+#
+# Usage: bench_storage.py [-n sizes] [-s stores] [-r repeats] [-b body-size]
+
+import socket, threading, time, random, optparse
+
+import benchutil
+
+class Client:
+    """Sends commands to an NNTPServer over a socket pair, one at a
+    time, and times each response."""
+
+    def __init__(self, nntp):
+        (server_sock, self.sock) = socket.socketpair()
+        self.server_sock = server_sock
+        self.server = nntp.NNTPServer(input=server_sock.makefile('r'),
+                                      output=server_sock.makefile('w'))
+        self.thread = threading.Thread(target=self.server.process_commands)
+        self.thread.start()
+        self.buf = ''
+        self.read_line()
+
+    def read_line(self):
+        while '\r\n' not in self.buf:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buf += data
+
+        (line, self.buf) = self.buf.split('\r\n', 1)
+        return line
+
+    def read_block(self):
+        while True:
+            i = self.buf.find('\r\n.\r\n')
+            if i >= 0 or self.buf.startswith('.\r\n'):
+                break
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buf += data
+
+        if self.buf.startswith('.\r\n'):
+            self.buf = self.buf[3:]
+        else:
+            self.buf = self.buf[i + 5:]
+
+    def command(self, cmd):
+        """Send a command and read the whole response.  Returns the
+        time taken."""
+        start = time.time()
+        self.sock.sendall(cmd + '\r\n')
+        status = self.read_line()
+        if status[:3] in ('215', '224', '220'):
+            self.read_block()
+        return time.time() - start
+
+    def close(self):
+        self.sock.sendall('QUIT\r\n')
+        self.thread.join()
+        self.server_sock.close()
+        self.sock.close()
+
+def measure(client, commands, repeats):
+    """Return the median latency of each command, run repeats times."""
+    res = []
+    for cmd in commands:
+        times = sorted(client.command(cmd) for i in range(repeats))
+        res.append(times[len(times) // 2])
+    return res
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--sizes', default="1000,10000,100000",
+                      help="comma-separated numbers of articles")
+    parser.add_option('-s', '--stores', default="files,sqlite",
+                      help="comma-separated kinds of store")
+    parser.add_option('-r', '--repeats', type='int', default=20)
+    parser.add_option('-b', '--body-size', type='int', default=500)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+
+    sizes = [int(n) for n in opts.sizes.split(',')]
+    stores = opts.stores.split(',')
+    for n in sizes:
+        rand = random.Random(n)
+        nums = [rand.randint(1, n) for i in range(opts.repeats)]
+        for store in stores:
+            name = 'bench.storage.%s.%d' % (store, n)
+            start = time.time()
+            benchutil.make_group(name, n, opts.body_size, store)
+            created = time.time() - start
+
+            client = Client(nntp)
+            labels = ['LIST', 'GROUP', 'XOVER (100 articles)',
+                      'XOVER (whole group)']
+            latencies = measure(client, ['LIST ACTIVE ' + name,
+                                         'GROUP ' + name,
+                                         'XOVER %d-%d' % (n // 2, n // 2 + 99),
+                                         'XOVER 1-'], opts.repeats)
+
+            # a different article each time
+            client.command('GROUP ' + name)
+            times = sorted(client.command('ARTICLE %d' % num) for num in nums)
+            labels.append('ARTICLE')
+            latencies.append(times[len(times) // 2])
+            client.close()
+
+            print "%s store, %d articles" % (store, n)
+            benchutil.report("  creation", "%.1f" % created, "s")
+            for (label, t) in zip(labels, latencies):
+                benchutil.report("  " + label, "%.3f" % (t * 1000), "ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Measures the throughput of large XOVER responses, comparing the
+# current buffered response writer with the old behaviour of encoding
+# and flushing every line separately.
+#
+# Usage: bench_xover.py [-n articles] [-r repeats]
+
+import codecs, optparse
+
+import benchutil
+
+class LineFlushingWriter:
+    """The response writer NNTPServer used to have: a UTF-8 codec
+    writer over the socket file, flushed after every line."""
+
+    def __init__(self, output):
+        self.output = codecs.getwriter("utf-8")(output)
+
+    def write(self, data):
+        self.output.write(data)
+        if data.endswith('\r\n'):
+            self.output.flush()
+
+    def flush(self):
+        self.output.flush()
+
+def run_xover(nntp, group_name, line_flushing):
+    def server(input, output):
+        server = nntp.NNTPServer(input=input, output=output)
+        if line_flushing:
+            server.output = LineFlushingWriter(output)
+        return server
+
+    return benchutil.run_session(server, ['GROUP %s' % group_name,
+                                          'XOVER 1-', 'QUIT'])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--articles', type='int', default=5000)
+    parser.add_option('-r', '--repeats', type='int', default=3)
+    (opts, args) = parser.parse_args()
+
+    benchutil.setup()
+    import nntp
+    benchutil.make_group('bench.xover', opts.articles)
+
+    for (label, line_flushing) in (('flush per line (before)', True),
+                                   ('buffered (after)', False)):
+        best = None
+        for i in range(opts.repeats):
+            res = run_xover(nntp, 'bench.xover', line_flushing)
+            if best is None or res[0] < best[0]:
+                best = res
+
+        (elapsed, nbytes, calls, cpu) = best
+        print label
+        benchutil.report("  XOVER lines", opts.articles)
+        benchutil.report("  elapsed", "%.3f" % elapsed, "s")
+        benchutil.report("  lines/sec", "%.0f" % (opts.articles / elapsed))
+        benchutil.report("  response bytes", nbytes)
+        if calls:
+            benchutil.report("  write syscalls", calls[1])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# Shared scaffolding for the pnntprss benchmarks.
+#
+# Each benchmark runs against a throwaway pnntprss home directory
+# populated with synthetic groups, so that it never touches real
+# feed data.  setup() must be called before importing any pnntprss
+# modules, since settings.py reads $HOME when it is imported.
+
+import os, sys, time, tempfile, hashlib, atexit, shutil
+import socket, threading, zlib, resource
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup():
+    """Point pnntprss at a fresh temporary home directory, which is
+    removed when the benchmark exits."""
+    home = tempfile.mkdtemp(prefix="pnntprss-bench.")
+    atexit.register(shutil.rmtree, home, True)
+    os.makedirs(os.path.join(home, ".pnntprss", "groups"))
+    os.environ['HOME'] = home
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+
+    return home
+
+filler = ("<p>Lorem ipsum dolor sit amet, <a href='http://example.com/'>"
+          "consectetur</a> adipiscing elit, sed do eiusmod tempor "
+          "incididunt ut labore et dolore magna aliqua.</p>\n")
+
+def make_entry(i, body_size=2000):
+    """Produce a synthetic feed entry resembling those saved by update.py."""
+    id = "http://example.com/posts/%d" % i
+    t = tuple(time.gmtime(1300000000 + i * 3600))
+    body = (filler * (body_size // len(filler) + 1))[:body_size]
+    return {
+        'id': id,
+        'message_id': hashlib.md5(id).hexdigest(),
+        'link': id,
+        'title': u'Synthetic post number %d' % i,
+        'title_detail': {'type': 'text/plain', 'language': None,
+                         'base': u'http://example.com/', 'value':
+                         u'Synthetic post number %d' % i},
+        'author_detail': {'name': u'A. Writer',
+                          'email': u'writer@example.com'},
+        'content': [{'type': 'text/html', 'language': None,
+                     'base': u'http://example.com/', 'value': unicode(body)}],
+        'updated_parsed': t,
+        'feed_updated_parsed': t,
+    }
+
+def make_group(name, count, body_size=2000, storage=None):
+    """Create a group containing count synthetic articles.  body_size
+    may be a list of sizes to cycle through.  storage names the kind
+    of article store to use, if not the default."""
+    import group, overview
+
+    config = {'href': 'http://example.com/feed', 'title': u'Synthetic feed'}
+    if storage is not None:
+        config['storage'] = storage
+
+    g = group.NewGroup(name, config)
+    index = {}
+    if not isinstance(body_size, list):
+        body_size = [body_size]
+
+    for i in range(1, count + 1):
+        entry = make_entry(i, body_size[i % len(body_size)])
+        num = g.next_article_number()
+        index[entry['message_id']] = num
+        g.save_article(num, entry)
+
+    g.save_index(index)
+    g.save_config()
+    g.create()
+
+    g = group.Group(name)
+    overview.save(g, overview.build(g))
+    return g
+
+def syscall_counts():
+    """Return (read syscalls, write syscalls) made so far by this
+    process, or None if the kernel doesn't tell us."""
+    try:
+        f = open("/proc/self/io")
+        try:
+            fields = dict(l.split(': ') for l in f.read().splitlines())
+        finally:
+            f.close()
+        return (int(fields['syscr']), int(fields['syscw']))
+    except (IOError, KeyError, ValueError):
+        return None
+
+# per-thread CPU time on Linux
+rusage_who = getattr(resource, 'RUSAGE_THREAD', 1)
+
+def thread_cputime():
+    ru = resource.getrusage(rusage_who)
+    return ru.ru_utime + ru.ru_stime
+
+def run_session(server, commands, compress=False):
+    """Run an NNTP session over a socketpair.  server is called with
+    the input and output files of the server end, and returns the
+    NNTPServer to run (so nntp.NNTPServer itself will do).  A client
+    thread pipelines commands, after COMPRESS DEFLATE if compress is
+    true, and reads the responses.  Returns (elapsed, bytes, syscalls,
+    cpu): the wall-clock and CPU time spent in process_commands(), the
+    bytes received by the client, and (reads, writes) made meanwhile,
+    or None if the kernel doesn't tell us."""
+    (server_sock, client_sock) = socket.socketpair()
+    server = server(server_sock.makefile('r'), server_sock.makefile('w'))
+    data = ''.join(c + '\r\n' for c in commands)
+
+    result = {'bytes': 0, 'tail': '', 'error': None}
+    def receive(decompressor):
+        while True:
+            chunk = client_sock.recv(65536)
+            if not chunk:
+                break
+            result['bytes'] += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            result['tail'] = (result['tail'] + chunk)[-512:]
+
+    def client():
+        try:
+            decompressor = None
+            if compress:
+                client_sock.sendall('COMPRESS DEFLATE\r\n')
+                reply = ''
+                while reply.count('\r\n') < 2:
+                    chunk = client_sock.recv(4096)
+                    if not chunk:
+                        break
+                    result['bytes'] += len(chunk)
+                    reply += chunk
+                if '\r\n206 ' not in reply:
+                    raise Exception("compression not accepted")
+
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              -zlib.MAX_WBITS)
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data_out = (compressor.compress(data)
+                            + compressor.flush(zlib.Z_SYNC_FLUSH))
+            else:
+                data_out = data
+
+            # send from another thread, so that neither end blocks
+            # writing while the other is
+            sender = threading.Thread(target=client_sock.sendall,
+                                      args=(data_out,))
+            sender.start()
+            receive(decompressor)
+            sender.join()
+        except Exception as e:
+            result['error'] = e
+
+    t = threading.Thread(target=client)
+    t.start()
+    before = syscall_counts()
+    cpu = thread_cputime()
+    start = time.time()
+    server.process_commands()
+    elapsed = time.time() - start
+    cpu = thread_cputime() - cpu
+    after = syscall_counts()
+    server.output.flush()
+    server_sock.shutdown(socket.SHUT_RDWR)
+    server_sock.close()
+    t.join()
+    client_sock.close()
+
+    if result['error']:
+        raise result['error']
+    last = result['tail'].rstrip('\r\n').rsplit('\r\n', 1)[-1]
+    if commands[-1].upper() == 'QUIT' and not last.startswith('205 '):
+        raise Exception("incomplete session")
+
+    if before and after:
+        calls = (after[0] - before[0], after[1] - before[1])
+    else:
+        calls = None
+
+    return (elapsed, result['bytes'], calls, cpu)
+
+def report(label, value, unit=""):
+    print "%-40s %14s %s" % (label, value, unit)
@@ -0,0 +1,142 @@
+# Caches shared between the connections of an NNTP server.
+#
+# When connections are served by threads of a single process
+# (nntpserver.py --mode thread, or nntpasync.py), they can share
+# loaded groups, overviews, and decoded and rendered articles.  Each
+# cached item is stamped with its group's generation stamp (see
+# group.generation_stamp), and is discarded when the stamp changes.
+# The least recently used items are evicted to keep the cache within
+# a memory budget.
+#
+# When connections are served by separate processes there is nothing
+# to share, and NoCache simply loads everything afresh.
+
+import threading, collections
+
+import group, overview, active
+
+# Rough sizes, in bytes, used to account for cached items against the
+# budget.  A decoded entry takes several times the space of its
+# encoded form, and its rendered message about as much again.
+group_size = 4096
+entry_size_factor = 6
+
+class LRUCache:
+    """A thread-safe mapping from keys to stamped values, which holds
+    at most budget bytes worth of values, by their estimated sizes."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamp):
+        """Return the value for key, or None if it is missing or was
+        stored with a different stamp."""
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[0] != stamp:
+                if item is not None:
+                    self.size -= item[2]
+                self.misses += 1
+                return None
+
+            # reinsert as the most recently used
+            self.items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, stamp, value, size):
+        """Store a value of the given estimated size."""
+        if size > self.budget:
+            return
+
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+            self.items[key] = (stamp, value, size)
+            self.size += size
+            while self.size > self.budget:
+                (k, item) = self.items.popitem(last=False)
+                self.size -= item[2]
+
+class NoCache:
+    """Loads groups and articles directly, caching nothing."""
+
+    def group(self, name):
+        """Return the named Group.  Raises NoSuchGroupError."""
+        return group.Group(name)
+
+    def article_range(self, g):
+        """Return the (lowest, highest, count) triple for a group."""
+        return active.article_range(g)
+
+    def overview(self, g):
+        """Return the Overview of a group, or a StoreOverview if its
+        store can look up ranges of overview lines."""
+        return overview.reader(g)
+
+    def article(self, g, num):
+        """Return an Article of a group, or None if it does not
+        exist."""
+        return g.article(num)
+
+class Cache:
+    """Caches groups and articles, within a memory budget in bytes."""
+
+    def __init__(self, budget):
+        self.lru = LRUCache(budget)
+
+    def cached(self, key, stamp, load):
+        """Return the cached value for key, or call load() to produce
+        a (value, size) pair and cache the value.  None values are
+        not cached."""
+        val = self.lru.get(key, stamp)
+        if val is None:
+            (val, size) = load()
+            if val is not None:
+                self.lru.put(key, stamp, val, size)
+
+        return val
+
+    def current_group(self, name, stamp):
+        return self.cached(('group', name), stamp,
+                           lambda: (group.Group(name), group_size))
+
+    def group(self, name):
+        return self.current_group(name, group.generation_stamp(name))
+
+    def article_range(self, g):
+        stamp = group.generation_stamp(g.name)
+        return self.cached(('range', g.name), stamp,
+                           lambda: (active.article_range(g), 100))
+
+    def overview(self, g):
+        stamp = group.generation_stamp(g.name)
+
+        def load():
+            ov = overview.load(g)
+            return (ov, sum(len(l) for l in ov.lines) + 100 * len(ov))
+
+        return self.cached(('overview', g.name), stamp, load)
+
+    def article(self, g, num):
+        stamp = group.generation_stamp(g.name)
+
+        # articles need the current group config to be rendered
+        g = self.current_group(g.name, stamp)
+
+        def load():
+            data = g.store.load(num)
+            if data is None:
+                return (None, 0)
+
+            art = group.Article(g, num, g.decode_entry(data))
+            return (art, len(data) * entry_size_factor)
+
+        return self.cached(('article', g.name, num), stamp, load)
@@ -0,0 +1,234 @@
+# Serialization of the data stored in group directories: group
+# configurations, indexes and article entries.
+#
+# Values are written with the codec named by settings.storage_codec.
+# Encoded data starts with a header identifying the codec, so data
+# written with any codec can always be read back.  Data without a
+# header is the Python repr() text that pnntprss used to write, and is
+# parsed as a Python literal (never evaluated).
+#
+# Article entries may also be compressed (see Group.encode_entry),
+# optionally with a dictionary of strings common to a group's entries.
+# Compressed data has its own header, wrapping the encoded data.
+
+import marshal, ast, zlib, hashlib, heapq, time
+
+import settings
+
+# Encoded data starts with the magic string followed by a codec tag
+# byte.
+magic = 'PNR'
+
+def plain(val):
+    """Convert a value to the plain builtin types a codec can
+    represent.  In particular, feedparser's dict subclasses and
+    struct_times become dicts and tuples."""
+    if isinstance(val, dict):
+        return dict((plain(k), plain(v)) for (k, v) in val.iteritems())
+    elif isinstance(val, list):
+        return [plain(x) for x in val]
+    elif isinstance(val, (tuple, time.struct_time)):
+        return tuple(plain(x) for x in val)
+    else:
+        return val
+
+class ReprCodec:
+    """The original format: Python repr() text."""
+    name = 'repr'
+    tag = None
+
+    def dumps(self, val):
+        return repr(val)
+
+    def loads(self, data):
+        return ast.literal_eval(data)
+
+class MarshalCodec:
+    """The marshal module's binary format."""
+    name = 'marshal'
+    tag = '\x01'
+
+    def dumps(self, val):
+        return magic + self.tag + marshal.dumps(plain(val), 2)
+
+    def loads(self, data):
+        return marshal.loads(data[len(magic) + 1:])
+
+codecs = {}
+codecs_by_tag = {}
+
+def register(codec):
+    """Make a codec available for reading and writing."""
+    codecs[codec.name] = codec
+    if codec.tag is not None:
+        codecs_by_tag[codec.tag] = codec
+
+register(ReprCodec())
+register(MarshalCodec())
+
+class UnknownCodecError(Exception):
+    """An Exception indicating that data was written by an unknown codec."""
+    pass
+
+class MissingDictionaryError(Exception):
+    """An Exception indicating that data was compressed with a
+    dictionary that has not been loaded.  The argument is the id of
+    the dictionary."""
+    pass
+
+class Dictionary:
+    """A preset dictionary for compression: strings likely to occur in
+    the data compressed with it, so that even small values compress
+    well.
+
+    Python 2's zlib module cannot set a dictionary, so instead a raw
+    deflate compressor and decompressor are primed by passing the
+    dictionary through them, and copied for each value.  The output
+    for the dictionary itself is left out of the compressed data."""
+
+    def __init__(self, data):
+        self.data = data
+        self.id = hashlib.md5(data).digest()[:8]
+
+        c = zlib.compressobj(settings.article_compress_level, zlib.DEFLATED,
+                             -zlib.MAX_WBITS)
+        prefix = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        self.compressor = c
+
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        d.decompress(prefix)
+        self.decompressor = d
+
+    def name(self):
+        """The id of the dictionary, as a file name."""
+        return self.id.encode('hex')
+
+    def compress(self, data):
+        c = self.compressor.copy()
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        d = self.decompressor.copy()
+        return d.decompress(data) + d.flush()
+
+# loaded dictionaries, by id.  The ids are digests of the dictionaries,
+# so these can be shared by all groups.
+dictionaries = {}
+
+def add_dictionary(dictionary):
+    """Make a dictionary available for decompression."""
+    dictionaries[dictionary.id] = dictionary
+
+def train(samples, size, seglen=64, d=8):
+    """Build the data for a Dictionary of at most size bytes from
+    sample values (encoded, but not compressed).
+
+    Every d-byte string is scored by the number of samples it occurs
+    in.  Segments of the samples are then picked greedily by the
+    total score of the d-byte strings they contain which are not
+    already in the dictionary."""
+    freq = {}
+    for s in samples:
+        for dmer in set(s[i:i + d] for i in xrange(len(s) - d + 1)):
+            freq[dmer] = freq.get(dmer, 0) + 1
+
+    def score(seg):
+        # strings found in only one sample are no help
+        return sum(max(freq.get(seg[i:i + d], 0) - 1, 0)
+                   for i in xrange(len(seg) - d + 1))
+
+    heap = []
+    for s in samples:
+        for i in xrange(0, max(len(s) - seglen, 0) + 1, seglen // 2):
+            seg = s[i:i + seglen]
+            heap.append((-score(seg), seg))
+    heapq.heapify(heap)
+
+    chosen = []
+    total = 0
+    while heap and total < size:
+        seg = heapq.heappop(heap)[1]
+        # the score may have dropped since it was pushed
+        sc = score(seg)
+        if sc <= 0:
+            continue
+        if heap and sc < -heap[0][0]:
+            heapq.heappush(heap, (-sc, seg))
+            continue
+
+        chosen.append(seg)
+        total += len(seg)
+        for i in xrange(len(seg) - d + 1):
+            freq.pop(seg[i:i + d], None)
+
+    # deflate reaches nearer strings more cheaply, so put the best
+    # segments at the end
+    return ''.join(reversed(chosen))[-size:]
+
+class ZlibCompressor:
+    """Encoded data compressed with zlib."""
+    name = 'zlib'
+    tag = '\x02'
+
+    def compress(self, data, dictionary=None):
+        return (magic + self.tag
+                + zlib.compress(data, settings.article_compress_level))
+
+    def loads(self, data):
+        return loads(zlib.decompress(data[len(magic) + 1:]))
+
+class DictionaryCompressor:
+    """Encoded data compressed with a Dictionary, whose id follows the
+    header.  Without a dictionary, this is plain zlib compression."""
+    name = 'zlib-dict'
+    tag = '\x03'
+
+    def compress(self, data, dictionary=None):
+        if dictionary is None:
+            return compressors['zlib'].compress(data)
+
+        return magic + self.tag + dictionary.id + dictionary.compress(data)
+
+    def loads(self, data):
+        start = len(magic) + 1
+        id = data[start:start + 8]
+        dictionary = dictionaries.get(id)
+        if dictionary is None:
+            raise MissingDictionaryError(id)
+
+        return loads(dictionary.decompress(data[start + 8:]))
+
+compressors = {}
+
+def register_compressor(compressor):
+    """Make a compression method available for reading and writing.
+    Compressed data is read like any other encoded data."""
+    compressors[compressor.name] = compressor
+    codecs_by_tag[compressor.tag] = compressor
+
+register_compressor(ZlibCompressor())
+register_compressor(DictionaryCompressor())
+
+def codec_of(data):
+    """Return the codec that was used to encode some data."""
+    if not data.startswith(magic):
+        return codecs['repr']
+
+    codec = codecs_by_tag.get(data[len(magic):len(magic) + 1])
+    if codec is None:
+        raise UnknownCodecError(repr(data[:len(magic) + 1]))
+
+    return codec
+
+def dumps(val, codec_name=None):
+    """Encode a value, with the named codec or the configured one."""
+    return codecs[codec_name or settings.storage_codec].dumps(val)
+
+def compress(data, method, dictionary=None):
+    """Compress encoded data with the named method."""
+    return compressors[method].compress(data, dictionary)
+
+def loads(data):
+    """Decode a value, whichever codec it was encoded with, and
+    whether or not it was compressed."""
+    return codec_of(data).loads(data)
@@ -5,7 +5,7 @@
 
 import os, time
 
-import settings, group
+import settings, group, overview, active, msgid, arrivals
 
 logger = settings.get_logger('pnntprss.expire')
 
@@ -24,32 +24,42 @@ def expire(g):
             to_remove = set()
             
             for art in g.article_numbers():
-                stat = os.stat(g.article_file(art))
-                if now - stat.st_mtime > lifetime:
+                t = g.article_time(art)
+                if t is not None and now - t > lifetime:
                     to_remove.add(art)
 
             if to_remove:
                 logger.info("Expiring in " + g.name)
-                index = g.load_eval("index", {})
+                index = g.load_index()
                 
                 # XXX might need to generate index if it didn't exist
                 g.saferemove("index")
 
-                for (id, art) in index.items():
+                expired = []
+                for (id, val) in index.items():
+                    art = group.index_number(val)
                     if art in to_remove:
                         logger.info("Expiring article %s@%s (%s)"
                                     % (id, g.name, art))
                         del index[id]
+                        expired.append(group.message_id(id, g.name))
                 
                 # XXX need to catch exceptions so we always save next art number
-                g.save("index", repr(index))
+                g.save_index(index)
+                msgid.remove(expired)
+
+                ov = overview.load(g)
+                ov.remove(to_remove)
+                overview.save(g, ov)
                 
-                for art in to_remove:
-                    g.delete_article(art)
+                g.delete_articles(to_remove)
+
+                active.update(g)
     finally:
         g.lockfile.unlock()
 
 
 for g in group.groups():
     expire(g)
-    
+
+arrivals.prune(time.time() - settings.arrival_log_lifetime)
@@ -0,0 +1,217 @@
+# Fetching feeds over HTTP, reusing persistent connections.
+#
+# Many feeds live on the same few hosts.  Rather than opening a new
+# connection for every feed, as urllib2 does, we keep idle HTTP/1.1
+# connections in a pool keyed by host, and reuse them for later
+# requests to that host.  The pool is shared by all the threads of
+# update.py --daemon.
+#
+# fetch() returns a file-like response, which feedparser.parse()
+# accepts in place of a URL.
+
+import httplib, urllib, urlparse, socket, threading, time, email.utils
+import hashlib, tempfile
+from cStringIO import StringIO
+
+import feedparser
+
+import settings
+
+logger = settings.get_logger('pnntprss.fetch')
+
+# how many redirects to follow before giving up
+max_redirects = 5
+
+class FetchError(Exception):
+    """An Exception indicating that a feed could not be fetched."""
+    pass
+
+class ThrottledError(Exception):
+    """An Exception indicating that a host asked us to back off, with
+    a 429 or 503 response.  retry_after is the number of seconds to
+    wait before contacting the host again, or None if it didn't say."""
+
+    def __init__(self, host, retry_after):
+        Exception.__init__(self, "%s asked us to back off (retry after %s)"
+                           % (host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+# response codes indicating that we should back off
+throttled_codes = (429, 503)
+
+def parse_retry_after(value):
+    """Convert a Retry-After header value, either a number of seconds
+    or a HTTP date, into a number of seconds.  Returns None if it
+    can't be understood."""
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        return None
+
+    return max(email.utils.mktime_tz(t) - time.time(), 0)
+
+def feed_host(url):
+    """Return the host a feed URL refers to, for politeness limits.
+    Returns None for URLs without a host."""
+    return urlparse.urlsplit(url).hostname
+
+class ConnectionPool:
+    """Idle persistent HTTP connections, keyed by (scheme, host, port)."""
+
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        # how many connections we have opened, for the curious
+        self.opened = 0
+
+    def get(self, key):
+        """Return a connection to the given host, and whether it was
+        reused from the pool."""
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return (conns.pop(), True)
+
+            self.opened += 1
+
+        (scheme, host, port) = key
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(host, port), False)
+        else:
+            return (httplib.HTTPConnection(host, port), False)
+
+    def put(self, key, conn):
+        """Return a connection to the pool once a response has been
+        read in full."""
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+pool = ConnectionPool()
+
+def handles(url):
+    """Can fetch() retrieve the given URL?  If not, leave it to
+    feedparser."""
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        return False
+
+    # feedparser handles inline credentials, and urllib2 proxies
+    if '@' in parts.netloc or parts.scheme in urllib.getproxies():
+        return False
+
+    return True
+
+def spool(read, chunk_size=65536):
+    """Read a response body in chunks with the given read function,
+    computing its md5sum as it arrives.
+
+    Returns a file holding the body, positioned at the start, and the
+    md5sum.  The body is kept in memory unless it is large."""
+    f = tempfile.SpooledTemporaryFile(max_size=settings.feed_spool_max_memory)
+    md5 = hashlib.md5()
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+
+        md5.update(chunk)
+        f.write(chunk)
+
+    f.seek(0)
+    return (f, md5.hexdigest())
+
+def request(url, headers, pool):
+    """Make a single GET request, returning the httplib response, a
+    file holding its body, and the body's md5sum."""
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    while True:
+        (conn, reused) = pool.get(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            (body, md5) = spool(resp.read)
+            break
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # The server may have closed an idle connection just as
+            # we reused it.  Try again with a fresh one.
+            if not reused:
+                raise
+
+    if resp.will_close:
+        conn.close()
+    else:
+        pool.put(key, conn)
+
+    return (resp, body, md5)
+
+def fetch(url, etag=None, modified=None, agent=None, pool=pool):
+    """Fetch a feed, following redirects.
+
+    The result is a file-like response in the form feedparser.parse()
+    expects, with the md5sum of the body as its md5 attribute.  Its
+    status attribute is the status of the first redirect
+    if there was one, so a permanent redirect can be detected as with
+    feedparser's own fetching."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    # build the headers just as feedparser would
+    req = feedparser._build_urllib2_request(url, agent or settings.user_agent,
+                                            etag, modified, None, None, {})
+    headers = dict(req.header_items())
+
+    status = None
+    for i in range(max_redirects + 1):
+        (resp, body, md5) = request(url, headers, pool)
+        if status is None:
+            status = resp.status
+
+        location = resp.getheader('location')
+        if resp.status not in (301, 302, 303, 307, 308) or not location:
+            break
+
+        body.close()
+        url = urlparse.urljoin(url, location)
+    else:
+        raise FetchError("too many redirects")
+
+    res = urllib.addinfourl(body, resp.msg, url, resp.status)
+    res.status = status
+    res.md5 = md5
+    return res
+
+def not_modified(resp):
+    """Turn a response into one indicating that the feed has not
+    changed, discarding its body."""
+    resp.close()
+    res = urllib.addinfourl(StringIO(''), resp.headers, resp.url, 304)
+    res.status = 304
+    res.md5 = resp.md5
+    return res
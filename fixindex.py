@@ -2,7 +2,7 @@
 
 import os, sys
 
-import settings, group
+import settings, group, overview, active, update, msgid
 
 def fix_index(g):
     if not g.lockfile.trylock():
@@ -12,24 +12,39 @@ def fix_index(g):
     try:
         print "Examining " + g.name
         id_to_arts = {}
-        for art in g.article_numbers():
-            id = g.article(art).entry['message_id']
-            id_to_arts.setdefault(id, set()).add(art)
+        for art in g.articles():
+            id = art.entry['message_id']
+            id_to_arts.setdefault(id, set()).add(art.number())
 
         index = {}
         dangling_arts = []
         for id in id_to_arts:
             arts = sorted(id_to_arts[id])
-            index[id] = arts[0]
+            entry = g.article(arts[0]).entry
+            index[id] = (arts[0], update.entry_fingerprint(entry))
             dangling_arts.extend(arts[1:])
 
-        if dangling_arts:
+        if dangling_arts and g.store.name == 'files':
             print "Renaming %d dangling articles" % len(dangling_arts)
             for art in dangling_arts:
                 art = str(art)
                 os.rename(g.group_file(art), g.group_file("dangling-"+art))
-
-        g.save("index", repr(index))
+        elif dangling_arts:
+            # duplicates of other articles, so no loss
+            print "Deleting %d dangling articles" % len(dangling_arts)
+            g.delete_articles(dangling_arts)
+
+        g.save_index(index)
+        msgid.replace_group(g.name, msgid.group_nums(g))
+
+        print "Rebuilding overview"
+        overview.save(g, overview.build(g))
+
+        if g.spooling():
+            print "Rendering articles"
+            for art in g.articles():
+                g.spool_article(art)
+        active.update(g)
     finally:
         g.lockfile.unlock()
 
@@ -1,14 +1,17 @@
 # Classes representing groups and articles.
 
-import os, os.path, time, warnings, cgi
+import os, os.path, time, warnings, cgi, errno, bisect
 
-import settings, message, lockfile
+import settings, message, lockfile, codec, arrivals, storage
 
 # we use tempnam safely.
 warnings.filterwarnings('ignore', 'tempnam', RuntimeWarning, 'group')
 
 class OpenRange:
     """An OpenRange object contains everything."""
+    lo = None
+    hi = None
+
     def __init__(self):
         pass
 
@@ -25,10 +28,6 @@ class Range:
     def __contains__(self, num):
         return (self.lo is None or num >= self.lo) and (self.hi is None or num <= self.hi)
 
-def isdigit(c):
-    """Return true if the given character is a digit."""
-    return c >= '0' and c <= '9'
-
 def saferemove(path):
     """Remove a file which does not necessarily exist."""
     try:
@@ -44,10 +43,44 @@ class GroupAlreadyExistsError(Exception):
     """An Exception indicating that a group with the specified name already exists"""
     pass
 
+def index_number(val):
+    """Return the article number from a value in a group's index.
+
+    Indexes map entry ids to (article number, entry fingerprint)
+    pairs.  Older indexes hold just the article number."""
+    if isinstance(val, tuple):
+        return val[0]
+    else:
+        return val
+
 def group_path(group_name):
     """The proper path name for the directory of the named group."""
     return "%s/%s" % (settings.groups_dir, group_name)
 
+def message_id(id, group_name):
+    """Return the message-id of the article for the entry with the
+    given normalized id in the named group."""
+    return "<%s@%s>" % (id, group_name)
+
+def generation_stamp(group_name):
+    """Return a value which changes whenever the named group's
+    generation is bumped.  It takes a single stat() call, so servers
+    can cheaply check whether what they know about the group is
+    current."""
+    path = group_path(group_name)
+    try:
+        st = os.stat(os.path.join(path, "generation"))
+        return (st.st_ino, st.st_mtime)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    # a group that has never been bumped
+    if not os.path.isdir(path):
+        raise NoSuchGroupError(group_name)
+
+    return None
+
 class Group:
     """A NNTP group, and its associated feed information."""
     
@@ -63,26 +96,45 @@ class Group:
         self.path = path
 
         if config is None:
-            config = self.load_eval("config", {})
+            config = self.load_value("config", {})
 
         self.config = config
         self.lockfile = lockfile.LockFile(self.group_file("lock"))
+        self.store = storage.store_for(self)
+
+        # the sorted article numbers, once needed; see numbers().
+        # Dropped by reload_config(), as it goes stale when other
+        # processes change the group.
+        self.number_index = None
 
     def group_file(self, fname):
         """Return the path name for the given file in the group's
         directory."""
         return os.path.join(self.path, fname)
 
-    def load_eval(self, fname, otherwise=None):
-        """Load and evaluate a file from the group's directory."""
-        path = self.group_file(fname)
-        if not os.path.exists(path):
+    def load(self, fname):
+        """Load the contents of a file from the group's directory.
+
+        Returns None if the file does not exist."""
+        try:
+            f = file(self.group_file(fname))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def load_value(self, fname, otherwise=None):
+        """Load and decode a value from a file in the group's directory."""
+        data = self.load(fname)
+        if data is None:
             return otherwise
-        
-        f = file(path)
-        expr = f.read()
-        f.close()
-        return eval(expr)
+
+        return codec.loads(data)
 
     def reload_config(self):
         """Reload the group's configuration data.
@@ -90,11 +142,19 @@ class Group:
         The configuration data is loaded when the Group object is
         constructed.  But if it may have changed, this function can be
         used to reload it."""
-        self.config = self.load_eval("config", {})
+        self.config = self.load_value("config", {})
+
+        # migrate.py may have moved the articles to another store
+        if self.config.get("storage", settings.article_storage) \
+                != self.store.name:
+            self.store = storage.store_for(self)
+
+        # other processes may have added or deleted articles too
+        self.number_index = None
 
     def save_config(self):
         """Save the group's configuration data."""
-        self.save("config", repr(self.config))
+        self.save_value("config", self.config)
 
     def save(self, fname, val):
         """Save a value into a file in the group's directory."""
@@ -105,75 +165,303 @@ class Group:
         f.close()
         os.rename(tmppath, path)
 
+    def save_value(self, fname, val):
+        """Encode a value and save it into a file in the group's
+        directory."""
+        self.save(fname, codec.dumps(val))
+
     def saferemove(self, fname):
         """Remove a file in the group's directory.
 
         It is not an error if the file does not exist."""
         saferemove(self.group_file(fname))
 
-    def ready_to_check(self, t):
-        """Do we need to poll the group's feed at time t?"""
+    def bump_generation(self):
+        """Note that the group's articles or configuration have
+        changed, so that servers discard anything they have cached
+        for it."""
+        try:
+            gen = int(self.load("generation") or 0)
+        except ValueError:
+            gen = 0
+
+        self.save("generation", "%d\n" % (gen + 1))
+
+    def adaptive(self):
+        """Is the poll interval of this group learned from its feed?"""
+        return self.config.get("adaptive", settings.feed_poll_adaptive)
+
+    def poll_interval(self):
+        """The interval between polls of the group's feed."""
+        interval = self.config.get("interval", settings.feed_poll_interval)
+        if self.adaptive():
+            interval = self.config.get("learned_interval", interval)
+
+        return interval
+
+    def record_arrival(self, t):
+        """Note that new entries appeared in the feed at time t."""
+        arrivals = self.config.get("arrivals", [])
+        arrivals.append(t)
+        self.config["arrivals"] = arrivals[-settings.feed_poll_arrival_history:]
+
+    def learn_poll_interval(self, t):
+        """Estimate the rate at which new entries appear in the feed,
+        as of time t, and pick a poll interval to match.
+
+        We poll twice per expected arrival, within the bounds given by
+        settings.  Until there are two arrivals to go on, the
+        configured interval is used."""
+        arrivals = self.config.get("arrivals", [])
+        if len(arrivals) < 2:
+            self.config.pop("learned_interval", None)
+            return
+
+        # The time since the last arrival counts too, so that a feed
+        # which has gone quiet gets polled less often.
+        mean_gap = (t - arrivals[0]) / (len(arrivals) - 1)
+        interval = min(max(mean_gap / 2, settings.feed_poll_min_interval),
+                       settings.feed_poll_max_interval)
+        self.config["learned_interval"] = int(interval)
+
+    def next_poll_time(self):
+        """When should we next poll the group's feed?"""
         polled_at = self.config.get("lastpolled", 0)
         failed_at = self.config.get("last_failed_poll", 0)
-        interval = self.config.get("interval", settings.feed_poll_interval)
+        interval = self.poll_interval()
 
         if failed_at > polled_at:
-            next_poll = failed_at + min(interval,
-                                    60 << self.config.get("failed_polls", 0))
+            return failed_at + min(interval,
+                                   60 << self.config.get("failed_polls", 0))
         else:
-            next_poll = polled_at + interval
+            return polled_at + interval
 
-        return t >= next_poll
+    def ready_to_check(self, t):
+        """Do we need to poll the group's feed at time t?"""
+        return t >= self.next_poll_time()
 
     def article_range(self):
         """Determine a (lowest article number, highest article number,
         article count) triple for the group."""
-        lowest = self.config.get('next_article_number', 1)
-        highest = lowest - 1
-        count = 0
-
-        for f in os.listdir(self.path):
-            if isdigit(f[0]):
-                f = int(f)
-                count += 1
-                if f < lowest:
-                    lowest = f
-                if f > highest:
-                    highest = f
+        if self.number_index is not None:
+            nums = self.number_index
+            count = len(nums)
+            if count:
+                (lowest, highest) = (nums[0], nums[-1])
+        else:
+            (lowest, highest, count) = self.store.extent()
+
+        if not count:
+            lowest = self.config.get('next_article_number', 1)
+            highest = lowest - 1
 
         return (lowest, highest, count)
 
+    def load_index(self):
+        """Load the group index, mapping the ids of feed entries to
+        article numbers."""
+        return self.store.load_index()
+
+    def save_index(self, index):
+        self.store.save_index(index)
+
     def article(self, num):
         """Fetch an Article object for the given article number.
 
         Returns None if the article does not exist."""
-        entry = self.load_eval(str(num))
-        if entry is not None:
-            return Article(self, num, entry)
+        data = self.store.load(num)
+        if data is not None:
+            return Article(self, num, self.decode_entry(data))
         else:
             return None
 
+    def compression(self):
+        """Return the method used to compress article entries ('zlib'
+        or 'zlib-dict'), or None."""
+        return self.config.get("compression", settings.article_compression)
+
+    def dictionary_file(self, name):
+        return os.path.join("dictionaries", name)
+
+    def dictionary(self):
+        """Return the Dictionary used to compress new article entries,
+        or None if the group has none yet."""
+        name = self.config.get("dictionary")
+        if name is None:
+            return None
+
+        return self.load_dictionary(name.decode('hex'))
+
+    def load_dictionary(self, id):
+        """Return the Dictionary with the given id, loading it from
+        the group directory if need be."""
+        dictionary = codec.dictionaries.get(id)
+        if dictionary is None:
+            data = self.load(self.dictionary_file(id.encode('hex')))
+            if data is None:
+                raise codec.MissingDictionaryError(id)
+
+            dictionary = codec.Dictionary(data)
+            codec.add_dictionary(dictionary)
+
+        return dictionary
+
+    def train_dictionary(self):
+        """Train a new Dictionary on the most recent articles, and
+        use it to compress new article entries, updating the group
+        configuration held within this object.  Entries compressed
+        with older dictionaries can still be read."""
+        nums = self.numbers()[-settings.article_dictionary_samples:]
+        samples = [codec.dumps(self.article(n).entry) for n in nums]
+        dictionary = codec.Dictionary(
+            codec.train(samples, settings.article_dictionary_size))
+
+        if not os.path.isdir(self.group_file("dictionaries")):
+            os.mkdir(self.group_file("dictionaries"))
+
+        self.save(self.dictionary_file(dictionary.name()), dictionary.data)
+        codec.add_dictionary(dictionary)
+        self.config["dictionary"] = dictionary.name()
+        return dictionary
+
+    def encode_entry(self, entry, codec_name=None):
+        """Encode an article entry, compressing it if the group is
+        configured to."""
+        data = codec.dumps(entry, codec_name)
+        method = self.compression()
+        if method is None:
+            return data
+
+        dictionary = None
+        if method == 'zlib-dict':
+            dictionary = self.dictionary()
+
+        return codec.compress(data, method, dictionary)
+
+    def decode_entry(self, data):
+        """Decode an article entry, however it was encoded."""
+        try:
+            return codec.loads(data)
+        except codec.MissingDictionaryError as e:
+            self.load_dictionary(e.args[0])
+            return codec.loads(data)
+
+    def spooling(self):
+        """Are wire-ready renderings of articles saved for this
+        group?"""
+        return self.config.get("spool", settings.article_spool)
+
+    def rendered_file(self, artnum):
+        return os.path.join("rendered", str(artnum))
+
+    def spool_article(self, art):
+        """Save the wire-ready rendering of an article."""
+        if not os.path.isdir(self.group_file("rendered")):
+            os.mkdir(self.group_file("rendered"))
+
+        (header, body) = art.rendered()
+        self.save(self.rendered_file(art.number()), header + '\r\n' + body)
+
+    def spooled_article(self, num):
+        """Fetch a SpooledArticle for the given article number.
+
+        Returns None if the article has no rendering."""
+        try:
+            f = file(self.group_file(self.rendered_file(num)), "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            return SpooledArticle(self, num, f)
+        except ValueError:
+            # not a complete rendering; use the entry instead
+            f.close()
+            return None
+
+    def numbers(self):
+        """Return the sorted list of article numbers.  It is built from
+        the store when first needed, and then kept up to date as
+        articles are saved and deleted through this object."""
+        if self.number_index is None:
+            self.number_index = sorted(self.store.numbers())
+        return self.number_index
+
+    def has_article(self, num):
+        if self.number_index is None:
+            # not worth listing every article for
+            return self.store.exists(num)
+
+        nums = self.number_index
+        i = bisect.bisect_left(nums, num)
+        return i < len(nums) and nums[i] == num
+
+    def next_number(self, num):
+        """Return the number of the first article after num, or None."""
+        nums = self.numbers()
+        i = bisect.bisect_right(nums, num)
+        if i == len(nums):
+            return None
+        return nums[i]
+
+    def previous_number(self, num):
+        """Return the number of the last article before num, or None."""
+        nums = self.numbers()
+        i = bisect.bisect_left(nums, num)
+        if i == 0:
+            return None
+        return nums[i - 1]
+
     def save_article(self, artnum, entry):
-        self.save(str(artnum), repr(entry))
+        self.store.save(artnum, self.encode_entry(entry))
+        if self.number_index is not None and not self.has_article(artnum):
+            bisect.insort(self.number_index, artnum)
+        if self.spooling():
+            self.spool_article(Article(self, artnum, entry))
+        else:
+            # don't leave a rendering of the old entry behind
+            self.saferemove(self.rendered_file(artnum))
+
+    def delete_articles(self, artnums):
+        """Delete articles, and reclaim the space they took."""
+        self.store.delete(artnums)
+        self.store.compact()
+        if self.number_index is not None:
+            artnums = set(artnums)
+            self.number_index = [n for n in self.number_index
+                                 if n not in artnums]
+        for artnum in artnums:
+            self.saferemove(self.rendered_file(artnum))
 
     def delete_article(self, artnum):
-        self.saferemove(str(artnum))
-    
-    def article_file(self, artnum):
-        return self.group_file(str(artnum))
+        self.delete_articles([artnum])
+
+    def article_time(self, artnum):
+        """Return the time an article arrived, or None if it does not
+        exist."""
+        return self.store.time(artnum)
     
     def article_numbers(self, range=OpenRange()):
         """Generate the article numbers of articles in the group,
-        within the given range."""
-        for f in os.listdir(self.path):
-            if isdigit(f[0]):
-                f = int(f)
-                if f in range:
-                    yield f
+        within the given range, in order."""
+        nums = self.numbers()
+        start = 0
+        if range.lo is not None:
+            start = bisect.bisect_left(nums, range.lo)
+        end = len(nums)
+        if range.hi is not None:
+            end = bisect.bisect_right(nums, range.hi)
+
+        for i in xrange(start, end):
+            yield nums[i]
 
     def articles(self, range=OpenRange()):
-        """Return all articles in the group, in article number order."""
-        return [self.article(n) for n in sorted(self.article_numbers(range))]
+        """Generate the articles in the group within the given range,
+        in article number order.  Each is loaded only when it is
+        reached, so the whole range is never in memory at once."""
+        for (num, data) in self.store.scan(range.lo, range.hi):
+            yield Article(self, num, self.decode_entry(data))
 
     def next_article_number(self):
         """Produce an article number for the next new article,
@@ -183,7 +471,7 @@ class Group:
             num = self.article_range()[1] + 1
         else:
             # just in case...
-            while os.path.exists(self.group_file(str(num))):
+            while self.has_article(num):
                 num += 1
 
         self.config['next_article_number'] = num + 1
@@ -239,12 +527,18 @@ class NewGroup(Group):
         finally:
             lock.unlock()
 
-def groups():
-    """Return a sequence of all available groups."""
-    return [Group(d) for d in os.listdir(settings.groups_dir)
+        arrivals.log_group(self.name)
+
+def group_names():
+    """Return a sequence of the names of all available groups."""
+    return [d for d in os.listdir(settings.groups_dir)
             if not d.startswith(".")
             and os.path.isdir(group_path(d))]
 
+def groups():
+    """Return a sequence of all available groups."""
+    return [Group(d) for d in group_names()]
+
 def decode_implicit_utf8(s):
     if type(s) is not unicode:
         s = s.decode('utf-8')
@@ -277,6 +571,7 @@ class Article:
         self.group = group
         self.num = num
         self.entry = entry
+        self.rendered_message = None
 
     def same_entry(self, entry):
         """Is the given entry unchanged compared to the entry of this
@@ -296,7 +591,7 @@ class Article:
 
     def message_id(self):
         """Return the message-id of this article."""
-        return "<%s@%s>" % (self.entry['message_id'], self.group.name)
+        return message_id(self.entry['message_id'], self.group.name)
 
     def subject(self):
         """Return the subject header value of this article."""
@@ -382,3 +677,70 @@ class Article:
         msg.set_body(body['value'], body['type'])
         
         return msg
+
+    def rendered(self):
+        """Return the message for the article, as a (header bytes,
+        dot-stuffed body bytes) pair.
+
+        The message is only constructed once for each Article object,
+        so articles held in a cache are served without rebuilding
+        them."""
+        if self.rendered_message is None:
+            msg = self.make_message()
+            self.rendered_message = (msg.header_bytes(),
+                                     msg.dot_stuffed_body())
+
+        return self.rendered_message
+
+class SpooledArticle:
+    """An article served from the wire-ready rendering saved when it
+    was stored.
+
+    The rendering is the message header, a blank line, and the
+    dot-stuffed body, exactly as sent to NNTP clients.  Only the
+    header is read into memory; the body can be copied from the file
+    straight to the client."""
+
+    def __init__(self, group, num, f):
+        self.group = group
+        self.num = num
+        self.file = f
+        self.size = os.fstat(f.fileno()).st_size
+
+        data = ''
+        while True:
+            chunk = f.read(4096)
+            data += chunk
+            end = data.find('\r\n\r\n')
+            if end >= 0:
+                break
+            if not chunk:
+                raise ValueError("no end of header in rendered article")
+
+        # the header keeps the line ending of its last line
+        self.header = data[:end + 2]
+        self.body_offset = end + 4
+
+        self.msgid = None
+        for l in self.header.split('\r\n'):
+            if l.startswith('Message-ID: '):
+                self.msgid = l[12:]
+                break
+
+    def number(self):
+        """Return the article number."""
+        return self.num
+
+    def message_id(self):
+        """Return the message-id of this article."""
+        return self.msgid
+
+    def body_file(self):
+        """Return the open rendering, reopening it if it was closed
+        after an earlier response."""
+        if self.file.closed:
+            self.file = file(self.file.name, "rb")
+        return self.file
+
+    def close(self):
+        self.file.close()
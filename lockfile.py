@@ -79,9 +79,9 @@ class LockFile:
 
         return False
 
-    def lock(self):
+    def lock(self, poll_interval=5):
         while not self.trylock(True):
-            time.sleep(5)
+            time.sleep(poll_interval)
 
     def touch(self):
         """Touch the lock file, to avoid it becoming stale during an
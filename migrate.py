@@ -0,0 +1,139 @@
+#!/usr/bin/python
+#
+# Rewrites the stored configs, indexes and article entries of groups
+# using the storage codec configured in settings.storage_codec (or the
+# codec given with -c).  Article entries are also compressed according
+# to the group's compression setting, which -z changes; -t trains a
+# new compression dictionary first.  With -s, also moves the articles
+# of groups to the given kind of store (see storage.py).  With no
+# group names, migrates every group.
+
+import os, sys, optparse
+
+import settings, group, codec, active, storage, overview
+
+def convert_store(g, store_name):
+    """Move the articles, index and overview of a group to a
+    different kind of store."""
+    old = g.store
+    if old.name == store_name:
+        return
+
+    print "Moving articles from %s to %s" % (old.name, store_name)
+    new = storage.stores[store_name](g)
+    nums = sorted(old.numbers())
+    for num in nums:
+        # expire.py relies on the arrival times of articles, so
+        # preserve them.
+        new.save(num, old.load(num), old.time(num))
+
+    index = old.load_index()
+    lines = old.load_overview()
+
+    g.config["storage"] = store_name
+    g.save_config()
+    g.store = new
+    old.remove_metadata()
+    old.remove_all()
+
+    new.save_index(index)
+    if lines is None:
+        lines = overview.build(g).lines
+    new.save_overview(lines)
+    print "Moved %d articles" % len(nums)
+
+def remove_old_dictionaries(g):
+    """Remove the compression dictionaries of a group which are no
+    longer used, once all its entries have been rewritten."""
+    keep = None
+    if g.compression() == 'zlib-dict':
+        keep = g.config.get("dictionary")
+
+    path = g.group_file("dictionaries")
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name != keep:
+                g.saferemove(g.dictionary_file(name))
+
+def migrate(g, codec_name, store_name=None, compression=False, train=False):
+    if not g.lockfile.trylock():
+        print g.name + " locked"
+        return
+
+    try:
+        print "Migrating " + g.name
+        if store_name is not None:
+            convert_store(g, store_name)
+
+        if compression is not False:
+            g.config["compression"] = compression
+            g.save_config()
+
+        if train and g.compression() == 'zlib-dict':
+            print "Training compression dictionary"
+            g.train_dictionary()
+            g.save_config()
+
+        count = 0
+        for fname in ["config", "index"]:
+            data = g.load(fname)
+            if data is None or codec.codec_of(data).name == codec_name:
+                continue
+
+            g.save(fname, codec.dumps(codec.loads(data), codec_name))
+            count += 1
+
+        for num in g.article_numbers():
+            data = g.store.load(num)
+            if data is None:
+                continue
+
+            newdata = g.encode_entry(g.decode_entry(data), codec_name)
+            if newdata == data:
+                continue
+
+            g.store.save(num, newdata, g.store.time(num))
+            count += 1
+
+        g.store.compact()
+        remove_old_dictionaries(g)
+        print "Rewrote %d files" % count
+        active.update(g)
+    finally:
+        g.lockfile.unlock()
+
+parser = optparse.OptionParser(
+    usage="%prog [-c codec] [-s storage] [-z compression] [-t] [group...]")
+parser.add_option('-c', '--codec', default=settings.storage_codec,
+                  help="codec to convert to (%s)" % ', '.join(sorted(codec.codecs)))
+parser.add_option('-s', '--storage',
+                  help="kind of article store to move groups to (%s)"
+                  % ', '.join(sorted(storage.stores)))
+parser.add_option('-z', '--compression',
+                  help="compression for article entries (none, %s)"
+                  % ', '.join(sorted(codec.compressors)))
+parser.add_option('-t', '--train', action='store_true',
+                  help="train a new compression dictionary")
+(opts, args) = parser.parse_args()
+
+compression = False
+if opts.compression == 'none':
+    compression = None
+elif opts.compression is not None:
+    if opts.compression not in codec.compressors:
+        parser.error("unknown compression: " + opts.compression)
+    compression = opts.compression
+
+if opts.codec not in codec.codecs:
+    parser.error("unknown codec: " + opts.codec)
+
+if opts.storage is not None and opts.storage not in storage.stores:
+    parser.error("unknown storage: " + opts.storage)
+
+if args:
+    gs = [group.Group(arg) for arg in args]
+else:
+    gs = group.groups()
+
+for g in gs:
+    migrate(g, opts.codec, opts.storage, compression, opts.train)
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# The message-id index.
+#
+# The index maps the message-ids of the articles in all groups to
+# their group names and article numbers, so that articles can be
+# retrieved by message-id.  It is kept in the .msgid directory of the
+# groups directory, split into 256 shards by the first two hex digits
+# of the md5 of the message-id.  Each shard holds sorted lines
+#
+#     message-id group-name article-number
+#
+# so a lookup reads one small file and bisects it.  update.py and
+# expire.py add and remove entries as articles come and go.  Shards
+# are replaced atomically, so readers never need to lock.
+#
+# Run as a script, this rebuilds the index from the groups' indexes.
+
+import os, os.path, errno, hashlib, bisect
+
+import settings, lockfile, group
+
+def index_dir():
+    return os.path.join(settings.groups_dir, ".msgid")
+
+def shard_of(msgid):
+    return hashlib.md5(msgid).hexdigest()[:2]
+
+def all_shards():
+    return ['%02x' % i for i in range(256)]
+
+def load_shard(shard):
+    """Return the sorted lines of a shard."""
+    try:
+        f = file(os.path.join(index_dir(), shard))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+    try:
+        return f.read().splitlines()
+    finally:
+        f.close()
+
+def write_shard(shard, lines):
+    path = os.path.join(index_dir(), shard)
+    if not lines:
+        group.saferemove(path)
+        return
+
+    tmppath = path + ".new"
+    f = file(tmppath, "w")
+    try:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    finally:
+        f.close()
+
+    os.rename(tmppath, path)
+
+def lookup(msgid):
+    """Return the (group name, article number) pair for a
+    message-id, or None if it is not in the index."""
+    lines = load_shard(shard_of(msgid))
+    key = msgid + ' '
+    i = bisect.bisect_left(lines, key)
+    if i < len(lines) and lines[i].startswith(key):
+        (name, num) = lines[i][len(key):].split()
+        return (name, int(num))
+
+    return None
+
+def modify(shards, func):
+    """Apply func to the entries of each of the given shards, as a
+    dict mapping message-ids to (group name, article number) pairs,
+    and atomically replace the shards with the results."""
+    try:
+        os.mkdir(index_dir())
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    lock = lockfile.LockFile(os.path.join(settings.groups_dir, "msgid.lock"))
+    lock.lock(poll_interval=0.1)
+    try:
+        for shard in shards:
+            entries = {}
+            for l in load_shard(shard):
+                (msgid, name, num) = l.split()
+                entries[msgid] = (name, num)
+
+            func(shard, entries)
+            write_shard(shard, sorted('%s %s %s' % (msgid, name, num)
+                                      for (msgid, (name, num))
+                                      in entries.iteritems()))
+    finally:
+        lock.unlock()
+
+def by_shard(nums):
+    """Split a dict keyed by message-id into a dict of dicts, keyed
+    by shard."""
+    res = {}
+    for (msgid, val) in nums.iteritems():
+        res.setdefault(shard_of(msgid), {})[msgid] = val
+    return res
+
+def add(group_name, nums):
+    """Add entries for articles in a group.  nums maps message-ids to
+    article numbers."""
+    shards = by_shard(dict((msgid, (group_name, num))
+                           for (msgid, num) in nums.iteritems()))
+
+    def f(shard, entries):
+        entries.update(shards[shard])
+
+    modify(shards.keys(), f)
+
+def remove(msgids):
+    """Remove the entries for some message-ids."""
+    shards = by_shard(dict.fromkeys(msgids))
+
+    def f(shard, entries):
+        for msgid in shards[shard]:
+            entries.pop(msgid, None)
+
+    modify(shards.keys(), f)
+
+def replace_group(group_name, nums):
+    """Replace all the entries for a group.  This rewrites every
+    shard, so it is only for occasional use."""
+    shards = by_shard(dict((msgid, (group_name, num))
+                           for (msgid, num) in nums.iteritems()))
+
+    def f(shard, entries):
+        for (msgid, (name, num)) in entries.items():
+            if name == group_name:
+                del entries[msgid]
+
+        entries.update(shards.get(shard, {}))
+
+    modify(all_shards(), f)
+
+def group_nums(g):
+    """Return a dict mapping the message-ids of a group's articles to
+    their numbers, according to the group's index."""
+    return dict((group.message_id(id, g.name), group.index_number(val))
+                for (id, val) in g.load_index().iteritems())
+
+def rebuild():
+    """Rebuild the index from scratch."""
+    nums = {}
+    for g in group.groups():
+        for (msgid, num) in group_nums(g).iteritems():
+            nums[msgid] = (g.name, num)
+
+    shards = by_shard(nums)
+
+    def f(shard, entries):
+        entries.clear()
+        entries.update(shards.get(shard, {}))
+
+    modify(all_shards(), f)
+
+if __name__ == "__main__":
+    rebuild()
@@ -2,28 +2,293 @@
 #
 # NNTP protocol handling
 
-import sys, os, re, codecs, errno
+import sys, os, re, errno, logging, time, calendar, fnmatch, zlib, itertools
 
-import settings, group
+import settings, group, overview, active, caching, msgid, arrivals
 
 logger = settings.get_logger('pnntprss.nntp')
 
+def parse_range(s):
+    """Parse an article range, of the form n, n- or n-m.  Returns a
+    (lo, hi) pair, with hi None for an open range.  Raises ValueError
+    if the range is malformed."""
+    dash = s.find('-')
+    if dash < 0:
+        lo = hi = int(s)
+    elif dash == len(s) - 1:
+        lo = int(s[:dash])
+        hi = None
+    else:
+        lo = int(s[:dash])
+        hi = int(s[dash+1:])
+
+    return (lo, hi)
+
+def header_value(header, name):
+    """Return the value of a header field from the header bytes of an
+    article, or an empty string if it has no such field."""
+    prefix = name.lower() + ':'
+    for l in header.split('\r\n'):
+        if l.lower().startswith(prefix):
+            return l[len(prefix):].strip()
+
+    return ''
+
+def wildmat(pattern):
+    """Compile a wildmat (RFC 3977 section 4) into a function which
+    tests whether a group name matches it.
+
+    A wildmat is a comma-separated list of patterns, of which the
+    last to match a name decides; those starting with ! exclude it."""
+    pats = []
+    for p in pattern.split(','):
+        negated = p.startswith('!')
+        if negated:
+            p = p[1:]
+        pats.append((negated, re.compile(fnmatch.translate(p))))
+
+    pats.reverse()
+
+    def match(name):
+        for (negated, r) in pats:
+            if r.match(name):
+                return not negated
+
+        return False
+
+    return match
+
+def parse_datetime(params):
+    """Parse the date, time and optional GMT parameters of NEWNEWS and
+    NEWGROUPS into a timestamp.  Raises ValueError if they are
+    malformed."""
+    if len(params) == 3:
+        if params[2].upper() != 'GMT':
+            raise ValueError("expected GMT")
+    elif len(params) != 2:
+        raise ValueError("expected a date and time")
+
+    (date, hms) = params[:2]
+    if len(date) == 6:
+        # two digit years are in the last century
+        current = time.gmtime().tm_year
+        year = current - current % 100 + int(date[:2])
+        if year > current:
+            year -= 100
+        date = str(year) + date[2:]
+    elif len(date) != 8:
+        raise ValueError("bad date")
+
+    if len(hms) != 6:
+        raise ValueError("bad time")
+
+    t = time.strptime(date + hms, '%Y%m%d%H%M%S')
+    if len(params) == 3:
+        return calendar.timegm(t)
+    else:
+        return time.mktime(t)
+
+# Python 2 has no os.sendfile, but the pysendfile package provides it
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, 'sendfile', None)
+
 # RFC977: commands with parameters must separate the parameters from
 # each other and from the command by one or more space or tab
 # characters.
 separator_re = re.compile(r'\s+')
 
-class NNTPServer:
-    """An object representing the server side of an NNTP connection."""
-    
-    def __init__(self, input, output):
+# commands which retrieve an article
+retrieval_commands = ('ARTICLE', 'HEAD', 'BODY', 'STAT')
+
+class LineReader:
+    """A buffered reader for the lines sent by the NNTP client.
+
+    Clients often pipeline commands, so we read as much as is
+    available with each system call, and hand out the buffered lines
+    one at a time."""
+
+    def __init__(self, input, bufsize=16384):
+        # hold on to the file object, so that its descriptor stays open
+        self.input = input
+        self.fd = input.fileno()
+        self.bufsize = bufsize
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decompressor = None
+
+    def start_decompression(self):
+        """Treat everything read from now on as a raw deflate stream,
+        as for RFC 8054 COMPRESS DEFLATE."""
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def fill(self):
+        """Read more data from the connection.  Returns False at EOF."""
+        while True:
+            try:
+                data = os.read(self.fd, self.bufsize)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+
+            if data and self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+                if not data:
+                    # only part of a compressed block so far
+                    continue
+
+            break
+
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def pending(self):
+        """Is there a complete line already in the buffer?"""
+        return self.buf.find('\n', self.pos) >= 0
+
+    def readline(self):
+        """Return the next line, without its line ending, or None
+        when the client has closed the connection."""
+        while True:
+            nl = self.buf.find('\n', self.pos)
+            if nl >= 0:
+                l = self.buf[self.pos:nl]
+                self.pos = nl + 1
+                break
+
+            if self.eof or not self.fill():
+                # a final unterminated line still counts
+                l = self.buf[self.pos:]
+                self.buf = ''
+                self.pos = 0
+                if not l:
+                    return None
+                break
+
+        if l.endswith('\r'):
+            l = l[:-1]
+
+        return l
+
+class ResponseWriter:
+    """Collects the bytes of NNTP responses in a buffer, and writes
+    them to the client in large chunks.
+
+    The buffer is written out when flush() is called at the end of a
+    response, or earlier if it grows beyond the watermark."""
+
+    def __init__(self, output, watermark=65536):
+        # hold on to the file object, so that its descriptor stays open
+        self.output = output
+        self.fd = output.fileno()
+        self.watermark = watermark
+        self.buf = bytearray()
+        self.compressor = None
+
+    def start_compression(self):
+        """Write out the buffer, and compress everything written after
+        it as a raw deflate stream, as for RFC 8054 COMPRESS DEFLATE."""
+        self.flush()
+        self.compressor = zlib.compressobj(settings.nntp_compress_level,
+                                           zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def write(self, data):
+        """Add some data to the buffer.  Unicode is encoded as UTF-8."""
+        if type(data) is unicode:
+            data = data.encode('utf-8')
+
+        self.buf += data
+        if len(self.buf) >= self.watermark:
+            self.flush()
+
+    def flush(self):
+        """Write out the contents of the buffer."""
+        if self.compressor is not None and self.buf:
+            # each flush ends a deflate block, so that the client can
+            # decompress the whole response
+            self.buf[:] = (self.compressor.compress(str(self.buf))
+                           + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+        view = memoryview(self.buf)
+        pos = 0
+        try:
+            while pos < len(self.buf):
+                try:
+                    pos += os.write(self.fd, view[pos:])
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            del view
+            del self.buf[:]
+
+    def write_file(self, f, offset, length):
+        """Write part of a file to the client, after anything already
+        in the buffer.  The data is copied by the kernel if possible."""
+        if sendfile is None or self.compressor is not None:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, self.watermark))
+                if not data:
+                    break
+                length -= len(data)
+                self.write(data)
+            return
+
+        self.flush()
+        fd = f.fileno()
+        while length > 0:
+            try:
+                n = sendfile(self.fd, fd, offset, length)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+
+            if n == 0:
+                # the file is shorter than we expected
+                break
+
+            offset += n
+            length -= n
+
+class NNTPProtocol:
+    """The server side of an NNTP session, independent of how the
+    connection is handled.
+
+    Each command line from the client is passed to dispatch(), or
+    pipelined lines to dispatch_batch().
+    Responses go to the output object, which has write() and flush()
+    methods; it should send the response when flushed.  Groups and
+    articles are obtained through the cache, which may be shared with
+    other connections (see caching.py)."""
+
+    greeting = '201 server ready - no posting allowed'
+
+    # the most pipelined commands processed as one batch
+    batch_size = 128
+
+    def __init__(self, output, cache=None):
         self.finished = False
         self.current_group = None
         self.current_article_number = None
+        self.compressing = False
         
-        # reopen input with universal line ending support
-        self.input = os.fdopen(input.fileno(), "rU", 0)
-        self.output = codecs.getwriter("utf-8")(output)
+        self.output = output
+        self.cache = cache or caching.NoCache()
+        self.debugging = logger.isEnabledFor(logging.DEBUG)
+
+        # articles loaded for the current batch of commands, by
+        # (group name, article number)
+        self.batch_articles = None
 
     def debug_in(self, l):
         logger.debug("< " + l)
@@ -31,67 +296,159 @@ class NNTPServer:
     def debug_out(self, l):
         logger.debug("> " + l)
 
-    def readlines(self):
-        """A generator yielding the lines sent by the NNTP client."""
-        # avoid using file as iterator, since it implies buffering
-        while True:
-            l = self.input.readline()
-            if not l:
-                break
-            
-            # remove trailing newline
-            if l[-1] == '\n':
-                l = l[0:-1]
+    def writeline(self, l):
+        """Write a line to the NNTP client.
 
-            logger.debug("< " + l)
-            yield l
+        Output is buffered until the end of the response."""
+        if self.debugging:
+            self.debug_out(l)
 
-    def writeline(self, l):
-        """Write a line to the NNTP client."""
-        self.debug_out(l)
         self.output.write(l)
         self.output.write('\r\n')
-        self.output.flush()
 
     def write(self, data):
-        """Write some data to the NNTP client."""
-        lines = data.split("\r\n")
-        for l in lines[:-1]:
-            self.debug_out(l)
+        """Write some data to the NNTP client.
+
+        Output is buffered until the end of the response."""
+        if self.debugging:
+            lines = data.split("\r\n")
+            for l in lines[:-1]:
+                self.debug_out(l)
 
-        if lines[-1]:
-            self.debug_out(lines[-1])
+            if lines[-1]:
+                self.debug_out(lines[-1])
             
         self.output.write(data)
-        self.output.flush()
 
-    def process_commands(self):
-        """Process NNTP commands comming from the client, until it
-        terminates the connection."""
-        self.writeline('201 server ready - no posting allowed')
+    def write_file(self, f, offset, length):
+        """Write part of a file to the NNTP client."""
+        if self.debugging:
+            self.debug_out("[%d bytes from %s]" % (length, f.name))
 
-        try:
-            for l in self.readlines():
-                tokens = separator_re.split(l)
-                if not tokens:
-                    self.writeline('501 command syntax error')
-
-                m = getattr(self, 'do_' + tokens[0].upper(), None)
-                if m:
-                    m(tokens[1:])
-                else:
-                    self.writeline('500 command not recognized')
+        self.output.write_file(f, offset, length)
 
+    def article_header(self, art):
+        """Return the header bytes of an article."""
+        if isinstance(art, group.SpooledArticle):
+            return art.header
+        else:
+            return art.rendered()[0]
+
+    def write_header(self, art):
+        """Write the header of an article."""
+        self.write(self.article_header(art))
+
+    def write_body(self, art):
+        """Write the dot-stuffed body of an article."""
+        if isinstance(art, group.SpooledArticle):
+            self.write_file(art.body_file(), art.body_offset,
+                            art.size - art.body_offset)
+            art.close()
+        else:
+            self.write(art.rendered()[1])
+
+    def release_article(self, art):
+        """Close the file of a spooled article that is no longer
+        needed."""
+        if isinstance(art, group.SpooledArticle):
+            art.close()
+
+    def dispatch(self, l):
+        """Process a command line from the client."""
+        tokens = separator_re.split(l)
+        if not tokens:
+            self.writeline('501 command syntax error')
+
+        m = getattr(self, 'do_' + tokens[0].upper(), None)
+        if m:
+            m(tokens[1:])
+        else:
+            self.writeline('500 command not recognized')
+
+    def dispatch_batch(self, lines, pause=None):
+        """Process a batch of pipelined command lines, stopping if
+        one finishes the session.  If pause is given and returns true
+        after a command, the rest of the lines are returned
+        undispatched.
+
+        The articles the batch retrieves from the current group are
+        loaded together first, and each article is only loaded once
+        for the whole batch, so that a HEAD and a BODY for the same
+        article share the work."""
+        self.batch_articles = {}
+        try:
+            self.prefetch(lines)
+            for (i, l) in enumerate(lines):
+                self.dispatch(l)
                 if self.finished:
                     break
-        except IOError as e:
-            # Swallow the exception when the connection is dropped
-            # with outstanding data:
-            if e.errno != errno.ECONNRESET:
-                raise
+                if pause is not None and pause():
+                    return lines[i + 1:]
+        finally:
+            for art in self.batch_articles.itervalues():
+                self.release_article(art)
+            self.batch_articles = None
+
+        return []
+
+    def prefetch(self, lines):
+        """Load the articles that a batch of command lines retrieve
+        by number from the current group, in article number order."""
+        if self.current_group == None:
+            return
+
+        nums = set()
+        for l in lines:
+            tokens = separator_re.split(l)
+            command = tokens[0].upper()
+            if command in ('GROUP', 'LISTGROUP'):
+                # later commands may refer to another group
+                break
+
+            if command in retrieval_commands and len(tokens) == 2 \
+                    and tokens[1].isdigit():
+                nums.add(int(tokens[1]))
+
+        if len(nums) > 1:
+            for num in sorted(nums):
+                self.load_article(self.current_group, num)
 
     # each do_* method handles the corresponding NNTP command.
 
+    def start_compression(self):
+        """Compress the rest of the session in both directions, after
+        sending the output so far uncompressed."""
+        self.output.start_compression()
+
+    def do_CAPABILITIES(self, params):
+        if params:
+            self.writeline('501 command syntax error')
+            return
+
+        self.writeline('101 capability list follows')
+        self.writeline('VERSION 2')
+        self.writeline('READER')
+        self.writeline('HDR')
+        self.writeline('OVER MSGID')
+        self.writeline('NEWNEWS')
+        self.writeline('LIST ACTIVE HEADERS OVERVIEW.FMT')
+        if not self.compressing:
+            self.writeline('COMPRESS DEFLATE')
+        self.writeline('.')
+
+    def do_COMPRESS(self, params):
+        if len(params) != 1 or params[0].upper() != 'DEFLATE':
+            self.writeline('501 command syntax error')
+            return
+
+        if self.compressing:
+            self.writeline('502 compression already active')
+            return
+
+        self.writeline('206 compression active')
+        self.start_compression()
+        self.compressing = True
+
     def do_MODE(self, params):
         if params and params[0].upper() == 'READER':
             self.writeline("201 Hello, you can't post")
@@ -107,140 +464,502 @@ class NNTPServer:
         self.finished = True
 
     def do_LIST(self, params):
-        if params:
+        if len(params) > 2:
+            self.writeline('501 command syntax error')
+            return
+
+        keyword = params and params[0].upper() or 'ACTIVE'
+        if len(params) == 2 and keyword != 'ACTIVE':
+            self.writeline('501 command syntax error')
+            return
+
+        if keyword == 'OVERVIEW.FMT':
+            self.writeline('215 order of fields in overview database')
+            for f in overview.fields:
+                self.writeline(f)
+            self.writeline('.')
+            return
+        elif keyword == 'HEADERS':
+            # HDR can retrieve any header
+            self.writeline('215 header and metadata list follows')
+            self.writeline(':')
+            self.writeline(':bytes')
+            self.writeline(':lines')
+            self.writeline('.')
+            return
+        elif keyword != 'ACTIVE':
             self.writeline('501 command syntax error')
             return
 
         self.writeline('215 list of newsgroups follows')
 
-        for g in group.groups():
-            (lowest, highest, count) = g.article_range()
-            self.writeline('%s %s %s n' % (g.name, highest, lowest))
+        # the active file only saves working out the ranges: groups
+        # that haven't been updated since it was written have no line
+        names = group.group_names()
+        if len(params) == 2:
+            names = filter(wildmat(params[1]), names)
 
+        self.write_active(names, active.load())
         self.writeline('.')
 
-    def do_GROUP(self, params):
-        if len(params) != 1:
+    def write_active(self, names, entries):
+        """Write the lines of the active list for the named groups,
+        given the loaded active entries."""
+        for name in names:
+            range = active.lookup(name, entries)
+            if range is None:
+                try:
+                    range = group.Group(name).article_range()
+                except group.NoSuchGroupError:
+                    # deleted since we listed the groups
+                    continue
+
+            (lowest, highest, count) = range
+            self.writeline('%s %s %s n' % (name, highest, lowest))
+
+    def do_NEWGROUPS(self, params):
+        try:
+            since = parse_datetime(params)
+        except ValueError:
+            self.writeline('501 command syntax error')
+            return
+
+        self.writeline('231 list of new newsgroups follows')
+        self.write_active(arrivals.new_groups(since), active.load())
+        self.writeline('.')
+
+    def do_NEWNEWS(self, params):
+        if not params:
             self.writeline('501 command syntax error')
             return
 
         try:
-            g = group.Group(params[0])
-        except group.NoSuchGroupError:
-            self.writeline('411 no such news group')
+            since = parse_datetime(params[1:])
+        except ValueError:
+            self.writeline('501 command syntax error')
             return
 
-        (lowest, highest, count) = g.article_range()
-        self.writeline('211 %s %s %s %s group selected'
-                       % (count, lowest, highest, g.name))
+        match = wildmat(params[0])
+        self.writeline('230 list of new articles by message-id follows')
+
+        for (name, id) in arrivals.new_articles(since):
+            if match(name):
+                self.writeline(id)
+
+        self.writeline('.')
 
+    def select_group(self, name):
+        """Make the named group the current group, returning its
+        (lowest, highest, count) triple, or None if there is no such
+        group."""
+        try:
+            g = self.cache.group(name)
+        except group.NoSuchGroupError:
+            self.writeline('411 no such news group')
+            return None
+
+        (lowest, highest, count) = self.cache.article_range(g)
+        self.current_group = g
         if lowest <= highest:
-            self.current_group = g
             self.current_article_number = lowest
         else:
-            self.current_group = None
             self.current_article_number = None
 
-    def do_XOVER(self, params):
-        if len(params) > 1:
+        return (lowest, highest, count)
+
+    def do_GROUP(self, params):
+        if len(params) != 1:
             self.writeline('501 command syntax error')
             return
 
-        if self.current_group == None:
+        range = self.select_group(params[0])
+        if range is None:
+            return
+
+        (lowest, highest, count) = range
+        self.writeline('211 %s %s %s %s group selected'
+                       % (count, lowest, highest, self.current_group.name))
+
+    def do_LISTGROUP(self, params):
+        if len(params) > 2:
+            self.writeline('501 command syntax error')
+            return
+
+        lo = hi = None
+        if len(params) == 2:
+            try:
+                (lo, hi) = parse_range(params[1])
+            except ValueError:
+                self.writeline('501 command syntax error')
+                return
+
+        if params:
+            range = self.select_group(params[0])
+            if range is None:
+                return
+        elif self.current_group == None:
             self.writeline('412 no newsgroup has been selected')
             return
+        else:
+            range = self.cache.article_range(self.current_group)
+            
+        (lowest, highest, count) = range
+        g = self.current_group
+        self.writeline('211 %s %s %s %s article numbers follow'
+                       % (count, lowest, highest, g.name))
+
+        for l in self.cache.overview(g).lines_in(lo, hi):
+            self.writeline(l[:l.index('\t')])
+
+        self.writeline('.')
+
+    def select_articles(self, arg):
+        """Interpret the range, message-id or (when arg is None)
+        current article argument of OVER and HDR.
+
+        Returns a (group, lo, hi, message-id) tuple, where the
+        message-id is None unless one was given, or None after
+        writing an error response."""
+        if arg is not None and arg.startswith('<'):
+            res = msgid.lookup(arg)
+            if res is not None:
+                try:
+                    g = self.cache.group(res[0])
+                    return (g, res[1], res[1], arg)
+                except group.NoSuchGroupError:
+                    pass
+
+            self.writeline('430 no article with that message-id')
+            return None
+
+        if self.current_group == None:
+            self.writeline('412 no newsgroup has been selected')
+            return None
+
+        if arg is None:
+            num = self.current_article_number
+            if num == None:
+                self.writeline('420 current article number is invalid')
+                return None
+
+            return (self.current_group, num, num, None)
 
-        # xXX prope range handling, including msgid and current
-        # article forms
-        range = params[0]
-        dash = range.find('-')
         try:
-            if dash < 0:
-                range = [int(range)]
-            elif dash == len(range)-1:
-                range = group.Range(lo=int(range[0:dash]))
-            else:
-                range = group.Range(lo=int(range[0:dash]),
-                                    hi=int(range[dash+1:]))
-        except:
+            (lo, hi) = parse_range(arg)
+        except ValueError:
+            self.writeline('501 command syntax error')
+            return None
+
+        return (self.current_group, lo, hi, None)
+
+    def selected_lines(self, selection):
+        """Return the overview lines for the articles selected by
+        select_articles().  If no article was found, writes an error
+        response and returns None."""
+        (g, lo, hi, id) = selection
+        lines = iter(self.cache.overview(g).lines_in(lo, hi))
+        if id is not None:
+            # check the index isn't out of date
+            idx = overview.field_index('Message-ID')
+            lines = (l for l in lines if overview.line_field(l, idx) == id)
+
+        # the lines are generated as they are written, so look at the
+        # first to see whether there are any
+        for first in lines:
+            return itertools.chain([first], lines)
+
+        if id is not None:
+            self.writeline('430 no article with that message-id')
+        elif lo == hi and g is self.current_group \
+                and lo == self.current_article_number:
+            self.writeline('420 current article number is invalid')
+        else:
+            self.writeline('423 no articles in that range')
+
+        return None
+
+    def do_OVER(self, params):
+        if len(params) > 1:
             self.writeline('501 command syntax error')
             return
 
-        arts = self.current_group.articles(range)
-        if not arts:
-            self.writeline('420 no articles in range')
+        selection = self.select_articles(params and params[0] or None)
+        if selection is None:
+            return
+
+        lines = self.selected_lines(selection)
+        if lines is None:
+            return
+
+        self.writeline('224 overview information follows')
+
+        for l in lines:
+            if selection[3] is not None:
+                # articles selected by message-id are numbered 0
+                l = '0' + l[l.index('\t'):]
+            self.writeline(l)
+
+        self.writeline('.')
+
+    do_XOVER = do_OVER
+
+    def do_HDR(self, params, response='225 headers follow'):
+        if len(params) not in (1, 2):
+            self.writeline('501 command syntax error')
+            return
+
+        selection = self.select_articles(len(params) == 2 and params[1]
+                                         or None)
+        if selection is None:
+            return
+
+        lines = self.selected_lines(selection)
+        if lines is None:
             return
-            
-        self.writeline('224 xover lines follow')
 
-        # XXX encoding
-        for art in arts:
-            fields = [str(art.number()), art.subject(), art.author(),
-                      art.date(), art.message_id(), '', '', '']
-            self.writeline("\t".join([f.replace("\t", " ") for f in fields]))
+        self.writeline(response)
+
+        g = selection[0]
+        idx = overview.field_index(params[0])
+        for l in lines:
+            num = l[:l.index('\t')]
+            if idx is not None:
+                value = overview.line_field(l, idx)
+            else:
+                # not in the overview, so look in the article itself
+                art = self.load_article(g, int(num), remember=False)
+                if art is None:
+                    continue
+                value = header_value(self.article_header(art), params[0])
+                self.release_article(art)
+
+            if selection[3] is not None:
+                num = '0'
+            self.writeline('%s %s' % (num, value))
 
         self.writeline('.')
 
+    def do_XHDR(self, params):
+        self.do_HDR(params, '221 header follows')
+
+    def load_article(self, g, num, remember=True):
+        """Fetch an article of a group, or None if it does not exist.
+        Unless remember is false, it is kept for the rest of the
+        batch."""
+        key = (g.name, num)
+        if self.batch_articles is not None and key in self.batch_articles:
+            return self.batch_articles[key]
+
+        # prefer the wire-ready rendering, if there is one
+        art = None
+        if g.spooling():
+            art = g.spooled_article(num)
+        if art is None:
+            try:
+                art = self.cache.article(g, num)
+            except group.NoSuchGroupError:
+                art = None
+
+        if self.batch_articles is not None and remember:
+            self.batch_articles[key] = art
+
+        return art
+
+    def article_by_message_id(self, id):
+        """Fetch an article in any group by its message-id, or None."""
+        res = msgid.lookup(id)
+        if res is None:
+            return None
+
+        (name, num) = res
+        try:
+            g = self.cache.group(name)
+        except group.NoSuchGroupError:
+            return None
+
+        art = self.load_article(g, num)
+        if art is None or art.message_id() != id:
+            # the index is out of date
+            return None
+
+        return art
+
     def retrieve_article(self, params):
-        """Fetch an Article according to the parameters of
-        ARTICLE, HEAD, BODY, and STAT."""
+        """Fetch an Article according to the parameters of ARTICLE,
+        HEAD, BODY, and STAT.  Returns the article number to give in
+        the response and the article, or None."""
         if len(params) > 1:
             self.writeline('501 command syntax error')
             return None
 
+        if params and params[0].startswith('<'):
+            # the current article is unaffected
+            art = self.article_by_message_id(params[0])
+            if art is None:
+                self.writeline('430 no article with that message-id')
+                return None
+
+            return (0, art)
+
         if self.current_group == None:
             self.writeline('412 no newsgroup has been selected')
             return None
 
-        if len(params) == 1:
-            self.current_article_number = int(params[0])
+        if params:
+            try:
+                num = int(params[0])
+            except ValueError:
+                self.writeline('501 command syntax error')
+                return None
         elif self.current_article_number == None:
             self.writeline('420 no current article has been selected')
             return None
+        else:
+            num = self.current_article_number
 
-        art = self.current_group.article(self.current_article_number)
+        art = self.load_article(self.current_group, num)
         if art == None:
             self.writeline('423 no such article number in this group')
             return None
 
-        return art
+        self.current_article_number = num
+        return (num, art)
 
     def do_ARTICLE(self, params):
-        art = self.retrieve_article(params)
-        if not art:
+        res = self.retrieve_article(params)
+        if not res:
             return
         
+        (num, art) = res
         self.writeline('220 %s %s article retrieved - head and body follow'
-                       % (art.number(), art.message_id()))
-        msg = art.make_message()
-        self.write(msg.header_bytes())
+                       % (num, art.message_id()))
+        self.write_header(art)
         self.writeline('')
-        self.write(msg.dot_stuffed_body())
+        self.write_body(art)
 
     def do_HEAD(self, params):
-        art = self.retrieve_article(params)
-        if not art:
+        res = self.retrieve_article(params)
+        if not res:
             return
         
+        (num, art) = res
         self.writeline('221 %s %s article retrieved - head follows'
-                       % (art.number(), art.message_id()))
-        self.write(art.make_message().header_bytes())
+                       % (num, art.message_id()))
+        self.write_header(art)
         self.writeline('.')
 
     def do_BODY(self, params):
-        art = self.retrieve_article(params)
-        if not art:
+        res = self.retrieve_article(params)
+        if not res:
             return
         
+        (num, art) = res
         self.writeline('222 %s %s article retrieved - body follows'
-                       % (art.number(), art.message_id()))
-        self.write(art.make_message().dot_stuffed_body())
+                       % (num, art.message_id()))
+        self.write_body(art)
 
     def do_STAT(self, params):
-        art = self.retrieve_article(params)
-        if not art:
+        res = self.retrieve_article(params)
+        if not res:
             return
         
+        (num, art) = res
         self.writeline('223 %s %s article exists'
-                       % (art.number(), art.message_id()))
+                       % (num, art.message_id()))
 
+    def move_article(self, params, forward):
+        """Make the next (or, unless forward, the previous) article
+        of the current group the current article, for NEXT and
+        LAST."""
+        if params:
+            self.writeline('501 command syntax error')
+            return
+
+        if self.current_group == None:
+            self.writeline('412 no newsgroup has been selected')
+            return
+
+        num = self.current_article_number
+        if num == None:
+            self.writeline('420 current article number is invalid')
+            return
+
+        g = self.current_group
+        while True:
+            if forward:
+                num = g.next_number(num)
+            else:
+                num = g.previous_number(num)
+
+            if num is None:
+                if forward:
+                    self.writeline('421 no next article in this group')
+                else:
+                    self.writeline('422 no previous article in this group')
+                return
+
+            # skip any article deleted since the numbers were listed
+            art = self.load_article(g, num)
+            if art is not None:
+                break
+
+        self.current_article_number = num
+        self.writeline('223 %s %s article retrieved - request text separately'
+                       % (num, art.message_id()))
+
+    def do_NEXT(self, params):
+        self.move_article(params, True)
+
+    def do_LAST(self, params):
+        self.move_article(params, False)
+
+class NNTPServer(NNTPProtocol):
+    """An object representing the server side of an NNTP connection,
+    using blocking I/O on the connection's socket."""
+    
+    def __init__(self, input, output, cache=None):
+        NNTPProtocol.__init__(self, ResponseWriter(output), cache)
+        self.input = LineReader(input)
+
+    def start_compression(self):
+        self.input.start_decompression()
+        self.output.start_compression()
+
+    def batches(self):
+        """A generator yielding the lines sent by the NNTP client, in
+        batches of the pipelined lines that are available together."""
+        while True:
+            l = self.input.readline()
+            if l is None:
+                break
+
+            batch = [l]
+            while len(batch) < self.batch_size and self.input.pending():
+                batch.append(self.input.readline())
+
+            if self.debugging:
+                for l in batch:
+                    self.debug_in(l)
+
+            yield batch
+
+    def process_commands(self):
+        """Process NNTP commands comming from the client, until it
+        terminates the connection."""
+        try:
+            self.writeline(self.greeting)
+            self.output.flush()
+
+            for batch in self.batches():
+                self.dispatch_batch(batch)
+
+                # send the complete responses
+                self.output.flush()
+
+                if self.finished:
+                    break
+        except EnvironmentError as e:
+            # Swallow the exception when the connection is dropped
+            # with outstanding data:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                raise
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+#
+# A single-process NNTP server, serving all connections from one
+# asyncore event loop.
+#
+# Commands are processed by the same NNTPProtocol as in nntpserver.py,
+# but on a small pool of executor threads, since they block on
+# filesystem reads.  Only one batch of pipelined commands per
+# connection is in progress at a time, so responses stay in order.
+# When a client is slow to read its responses, the rest of its batch
+# is set aside until they have been sent, rather than holding up an
+# executor thread.  An idle connection costs only a socket and a few
+# small objects, rather than a whole process.  All connections share
+# a cache of groups and articles (see caching.py).
+
+import asyncore, socket, os, sys, errno, threading, Queue, optparse, zlib
+import resource, collections
+
+import settings, nntp, caching
+
+logger = settings.get_logger('pnntprss.async')
+
+# stop reading from a client that has this many commands waiting
+max_queued_commands = 100
+
+# drop a client that sends a line longer than this
+max_line_length = 65536
+
+# stop processing a client's commands while this much output is
+# waiting to be sent to it, until it drops to the low-water mark.  A
+# command in progress runs to completion, so these bound the output
+# waiting beyond that of a single response.
+output_high_water = 262144
+output_low_water = 65536
+
+class Trigger(asyncore.file_dispatcher):
+    """Runs functions on the event loop thread on behalf of other
+    threads, waking the loop up through a pipe."""
+
+    def __init__(self, map):
+        (self.rfd, self.wfd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.rfd, map)
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+
+    def call(self, func, *args):
+        """Arrange for func(*args) to be called on the event loop
+        thread."""
+        with self.lock:
+            wake = not self.pending
+            self.pending.append((func, args))
+
+        if wake:
+            os.write(self.wfd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        with self.lock:
+            pending = self.pending
+            self.pending = collections.deque()
+
+        for (func, args) in pending:
+            func(*args)
+
+class Executor:
+    """A fixed pool of threads for running blocking tasks."""
+
+    def __init__(self, threads, trigger):
+        self.trigger = trigger
+        self.tasks = Queue.Queue()
+        for i in range(threads):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def submit(self, func, callback):
+        """Run func on an executor thread, and then callback(res, exc)
+        on the event loop thread, where res is the result of func and
+        exc is the exception it raised, or None."""
+        self.tasks.put((func, callback))
+
+    def worker(self):
+        while True:
+            (func, callback) = self.tasks.get()
+            res = None
+            exc = None
+            try:
+                res = func()
+            except Exception as e:
+                logger.exception("error processing command")
+                exc = e
+
+            self.trigger.call(callback, res, exc)
+
+class ConnectionWriter:
+    """The output object for the NNTPProtocol of a Connection.
+
+    It is written to on an executor thread.  Flushed data is handed to
+    the event loop to send."""
+
+    def __init__(self, conn, watermark=65536):
+        self.conn = conn
+        self.watermark = watermark
+        self.buf = bytearray()
+        self.compressor = None
+
+    def start_compression(self):
+        # the client sends nothing more until it sees our response,
+        # so input can be decompressed from now on
+        self.conn.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.flush()
+        self.compressor = zlib.compressobj(settings.nntp_compress_level,
+                                           zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def write(self, data):
+        if type(data) is unicode:
+            data = data.encode('utf-8')
+
+        self.buf += data
+        if len(self.buf) >= self.watermark:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            data = str(self.buf)
+            del self.buf[:]
+            if self.compressor is not None:
+                data = (self.compressor.compress(data)
+                        + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.conn.queue_output(data)
+
+    def write_file(self, f, offset, length):
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, self.watermark))
+            if not data:
+                break
+            length -= len(data)
+            self.write(data)
+
+class Connection(asyncore.dispatcher):
+    """A client connection."""
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self.server = server
+        self.inbuf = ''
+        self.commands = collections.deque()
+        self.busy = False
+        self.finishing = False
+        self.decompressor = None
+
+        # the rest of a batch set aside while output backs up
+        self.parked = None
+
+        # output waiting to be sent, shared with the executor thread
+        self.out_lock = threading.Lock()
+        self.outbuf = collections.deque()
+        self.pending = 0
+        self.closed = False
+
+        self.session = nntp.NNTPProtocol(ConnectionWriter(self),
+                                         server.cache)
+        self.outbuf.append(self.session.greeting + '\r\n')
+        self.pending = len(self.outbuf[0])
+
+    def queue_output(self, data):
+        """Queue data to be sent.  Called on an executor thread."""
+        with self.out_lock:
+            if self.closed:
+                return
+
+            self.outbuf.append(data)
+            self.pending += len(data)
+
+        self.server.trigger.call(lambda: None)
+
+    def backlogged(self):
+        """Is too much output waiting to be sent for more commands to
+        be processed?  Called on an executor thread."""
+        with self.out_lock:
+            return self.pending > output_high_water
+
+    def readable(self):
+        return (not self.finishing
+                and len(self.commands) < max_queued_commands)
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        data = self.recv(16384)
+        if not data:
+            return
+
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+
+        self.inbuf += data
+        lines = self.inbuf.split('\n')
+        self.inbuf = lines.pop()
+        if len(self.inbuf) > max_line_length:
+            logger.warning("line too long; dropping connection")
+            self.handle_close()
+            return
+
+        for l in lines:
+            if l.endswith('\r'):
+                l = l[:-1]
+            if self.session.debugging:
+                self.session.debug_in(l)
+            self.commands.append(l)
+
+        self.next_command()
+
+    def next_command(self):
+        if self.busy or self.finishing:
+            return
+
+        if self.parked is not None:
+            # rather than have an executor thread wait for a slow
+            # client, resume once its output has drained
+            with self.out_lock:
+                if self.pending > output_low_water:
+                    return
+
+            batch = self.parked
+            self.parked = None
+        elif self.commands:
+            batch = []
+            while self.commands and len(batch) < self.session.batch_size:
+                batch.append(self.commands.popleft())
+        else:
+            return
+
+        self.busy = True
+        session = self.session
+        backlogged = self.backlogged
+
+        def run():
+            rest = session.dispatch_batch(batch, backlogged)
+            session.output.flush()
+            return rest
+
+        self.server.executor.submit(run, self.command_done)
+
+    def command_done(self, rest, exc):
+        self.busy = False
+        if self.closed:
+            return
+
+        if exc is not None or self.session.finished:
+            self.finishing = True
+            if not self.outbuf:
+                self.handle_close()
+            return
+
+        if rest:
+            self.parked = rest
+
+        self.next_command()
+
+    def handle_write(self):
+        with self.out_lock:
+            while self.outbuf:
+                data = self.outbuf[0]
+                sent = self.send(data)
+                self.pending -= sent
+                if sent < len(data):
+                    self.outbuf[0] = data[sent:]
+                    break
+
+                self.outbuf.popleft()
+
+        if self.finishing and not self.outbuf:
+            self.handle_close()
+        elif self.parked is not None:
+            self.next_command()
+
+    def handle_close(self):
+        with self.out_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbuf.clear()
+
+        self.server.connections -= 1
+        self.close()
+
+    def handle_error(self):
+        logger.exception("error on connection")
+        self.handle_close()
+
+class Server(asyncore.dispatcher):
+    """Listens for connections."""
+
+    def __init__(self, port, max_connections, executor_threads):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', port))
+        self.listen(settings.nntp_listen_backlog)
+        self.max_connections = max_connections
+        self.connections = 0
+        self.cache = caching.Cache(settings.nntp_cache_size)
+        self.trigger = Trigger(self.map)
+        self.executor = Executor(executor_threads, self.trigger)
+
+    def readable(self):
+        # at the limit, leave new connections in the backlog
+        return self.connections < self.max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+
+        self.connections += 1
+        Connection(pair[0], self)
+
+    def handle_error(self):
+        logger.exception("error accepting connection")
+
+    def serve_forever(self):
+        asyncore.loop(timeout=30, use_poll=True, map=self.map)
+
+def raise_file_limit(wanted):
+    """Raise the limit on open files, if we can, to allow for many
+    connections."""
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', type='int', default=settings.nntp_port)
+    parser.add_option('-c', '--max-connections', type='int',
+                      default=settings.nntp_async_max_connections)
+    parser.add_option('-t', '--threads', type='int',
+                      default=settings.nntp_executor_threads,
+                      help="number of threads processing commands")
+    (opts, args) = parser.parse_args()
+
+    raise_file_limit(opts.max_connections + 64)
+    Server(opts.port, opts.max_connections, opts.threads).serve_forever()
@@ -2,24 +2,174 @@
 #
 # A trivial NNTP server process.  Hands off to NNTPServer to process
 # the connections.
+#
+# The server can run in one of three modes, chosen with --mode:
+#
+#   fork     fork a child process for each connection, with at most
+#            settings.nntp_max_connections at once (the default)
+#   prefork  fork a fixed pool of worker processes up front, each
+#            serving one connection at a time
+#   thread   serve connections from a fixed pool of threads, which
+#            share a cache of groups and articles (see caching.py)
+#
+# In the pool modes, the pool size (settings.nntp_workers, or
+# --workers) limits the number of concurrent connections.  In every
+# mode, connections beyond the limit wait in the listen backlog until
+# a worker is free.
 
-import socket, sys, os, signal
-
-import nntp
+import socket, sys, os, signal, optparse, threading, errno
 
-signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+import settings, nntp, caching
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind(('', 4321))
-s.listen(1)
+logger = settings.get_logger('pnntprss.server')
 
-while True:
-    conn, addr = s.accept()
-    pid = os.fork() 
-    if pid > 0:
-        conn.close()
-    else:
-        nntp.NNTPServer(input=conn.makefile('r'), output=conn.makefile('w')).process_commands()
+def serve(conn, cache=None):
+    """Process the NNTP commands on a connection, and close it."""
+    try:
+        nntp.NNTPServer(input=conn.makefile('r'),
+                        output=conn.makefile('w'),
+                        cache=cache).process_commands()
+    finally:
         conn.close()
+
+def serve_logging_errors(conn, cache=None):
+    """Like serve, but log exceptions rather than letting them
+    kill the worker."""
+    try:
+        serve(conn, cache)
+    except Exception:
+        logger.exception("error serving connection")
+
+def accept(s):
+    while True:
+        try:
+            return s.accept()[0]
+        except socket.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+def reap(children, block, unknown=None):
+    """Reap exited child processes, waiting for one if block is true
+    (but returning early if a signal arrives).  Reaped processes not
+    in children are added to unknown, if given."""
+    options = 0
+    if not block:
+        options = os.WNOHANG
+
+    while children or (unknown is not None and not block):
+        try:
+            (pid, status) = os.waitpid(-1, options)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                # the signal handler may have reaped what we waited for
+                return
+            if e.errno != errno.ECHILD:
+                raise
+            children.clear()
+            return
+
+        if pid == 0:
+            return
+
+        if pid in children:
+            children.discard(pid)
+        elif unknown is not None:
+            unknown.add(pid)
+        options = os.WNOHANG
+
+def serve_forking(s, max_connections):
+    children = set()
+
+    # children reaped by the signal handler before their pids were
+    # added to children
+    early = set()
+
+    # reap children as they exit, so that they don't linger as
+    # zombies while the server is idle
+    def child_exited(signum, frame):
+        reap(children, False, early)
+
+    signal.signal(signal.SIGCHLD, child_exited)
+
+    while True:
+        # when at the limit, leave new connections in the backlog
+        while len(children) >= max_connections:
+            reap(children, True)
+
+        conn = accept(s)
+        pid = os.fork()
+        if pid > 0:
+            conn.close()
+            children.add(pid)
+            if pid in early:
+                early.discard(pid)
+                children.discard(pid)
+        else:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            s.close()
+            serve(conn)
+            sys.exit(0)
+
+def serve_preforked(s, workers):
+    children = set()
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
         sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    while True:
+        # replace workers that have died
+        while len(children) < workers:
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                while True:
+                    serve_logging_errors(accept(s))
+
+            children.add(pid)
+
+        reap(children, True)
+
+def serve_threaded(s, workers):
+    cache = caching.Cache(settings.nntp_cache_size)
+
+    def worker():
+        while True:
+            serve_logging_errors(accept(s), cache)
+
+    for i in range(workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    while True:
+        signal.pause()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-m', '--mode', choices=['fork', 'prefork', 'thread'],
+                      default=settings.nntp_server_mode)
+    parser.add_option('-w', '--workers', type='int',
+                      default=settings.nntp_workers,
+                      help="size of the worker pool in the prefork and "
+                      "thread modes")
+    parser.add_option('-p', '--port', type='int', default=settings.nntp_port)
+    (opts, args) = parser.parse_args()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('', opts.port))
+    s.listen(settings.nntp_listen_backlog)
+
+    if opts.mode == 'prefork':
+        serve_preforked(s, opts.workers)
+    elif opts.mode == 'thread':
+        serve_threaded(s, opts.workers)
+    else:
+        serve_forking(s, settings.nntp_max_connections)
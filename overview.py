@@ -0,0 +1,136 @@
+# Per-group overview data.
+#
+# The overview of a group, kept by its store (see storage.py), holds
+# the precomputed OVER line of each article, in article number order,
+# so that OVER and HDR do not need to load every article in the range.
+
+# The fields of overview lines after the article number, as listed by
+# LIST OVERVIEW.FMT.
+fields = ['Subject:', 'From:', 'Date:', 'Message-ID:', 'References:',
+          ':bytes', ':lines']
+
+# older names for the metadata fields, used by XHDR clients
+field_aliases = {'bytes:': ':bytes', 'lines:': ':lines'}
+
+def field_index(name):
+    """Return the index within the tab-separated overview line of the
+    named header or metadata field, or None if it is not in the
+    overview."""
+    name = name.lower()
+    if not name.startswith(':'):
+        name += ':'
+    name = field_aliases.get(name, name)
+
+    for (i, f) in enumerate(fields):
+        if f.lower() == name:
+            return i + 1
+
+    return None
+
+def overview_line(art):
+    """Produce the overview line for an Article."""
+    (header, body) = art.rendered()
+    # the size and line count of the body exclude the terminating dot
+    fields = [str(art.number()), art.subject(), art.author(), art.date(),
+              art.message_id(), '',
+              str(len(header) + 2 + len(body) - 3),
+              str(body.count('\r\n') - 1)]
+    res = []
+    for f in fields:
+        if type(f) is unicode:
+            f = f.encode('utf-8')
+        res.append(f.replace("\t", " ").replace("\r", " ").replace("\n", " "))
+
+    return "\t".join(res)
+
+def line_number(line):
+    """Extract the article number from an overview line."""
+    return int(line[:line.index("\t")])
+
+def line_field(line, index):
+    """Extract a field from an overview line, by its index."""
+    return line.split("\t")[index]
+
+class Overview:
+    """The overview lines for the articles in a group."""
+
+    def __init__(self, lines=None):
+        self.lines = lines or []
+
+    def find(self, num):
+        """Return the index of the first line with an article number
+        not less than num."""
+        lo = 0
+        hi = len(self.lines)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if line_number(self.lines[mid]) < num:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lines_in(self, lo=None, hi=None):
+        """Generate the overview lines for articles numbered from lo
+        to hi, inclusive.  None means unbounded."""
+        start = 0
+        if lo is not None:
+            start = self.find(lo)
+
+        end = len(self.lines)
+        if hi is not None:
+            end = self.find(hi + 1)
+
+        for i in xrange(start, end):
+            yield self.lines[i]
+
+    def set(self, num, line):
+        """Add or replace the overview line for an article."""
+        i = self.find(num)
+        if i < len(self.lines) and line_number(self.lines[i]) == num:
+            self.lines[i] = line
+        else:
+            self.lines.insert(i, line)
+
+    def remove(self, nums):
+        """Remove the overview lines for the given article numbers."""
+        nums = set(nums)
+        self.lines = [l for l in self.lines if line_number(l) not in nums]
+
+    def __len__(self):
+        return len(self.lines)
+
+def build(g):
+    """Build the Overview for a group from its articles."""
+    return Overview([overview_line(art) for art in g.articles()])
+
+def load(g):
+    """Load the Overview for a group.  If the group has no overview,
+    it is built from the articles."""
+    lines = g.store.load_overview()
+    if lines is None:
+        return build(g)
+
+    return Overview(lines)
+
+class StoreOverview:
+    """The overview of a group whose store can look up ranges of
+    overview lines itself, so that they need not all be loaded."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def lines_in(self, lo=None, hi=None):
+        return self.store.overview_lines(lo, hi)
+
+def reader(g):
+    """Return an object whose lines_in method generates the overview
+    lines of a group, for serving OVER and HDR without keeping them."""
+    if hasattr(g.store, 'overview_lines'):
+        return StoreOverview(g.store)
+
+    return load(g)
+
+def save(g, ov):
+    """Save the Overview for a group."""
+    g.store.save_overview(ov.lines)
@@ -11,16 +11,113 @@ groups_dir = os.path.join(base_dir, "groups")
 # default feed polling interval
 feed_poll_interval = 1800
 
+# Adaptive polling: learn each feed's poll interval from how often new
+# entries appear in it, within the given bounds.  May be overridden
+# in group config.
+feed_poll_adaptive = False
+feed_poll_min_interval = 5 * 60
+feed_poll_max_interval = 24 * 60 * 60
+
+# how many recent arrivals of new entries to learn from
+feed_poll_arrival_history = 20
+
 # how long an article lives for.  may be overridden in group config.
 # None means forever
 article_lifetime = None
 
+# how long the arrivals of articles are remembered for NEWNEWS
+arrival_log_lifetime = 30 * 24 * 3600
+
+# how values such as article entries are stored in group directories:
+# 'marshal' (compact and fast) or 'repr' (Python literals, as older
+# versions of pnntprss wrote).  Either can always be read.
+storage_codec = 'marshal'
+
+# how group articles are stored: 'files' (one file per article),
+# 'segments' (appended to large segment files) or 'sqlite' (in an
+# SQLite database, with the group index and overview; see
+# storage.py).  May be overridden in group config.  migrate.py -s
+# converts groups.
+article_storage = 'files'
+
+# how article entries are compressed: None, 'zlib', or 'zlib-dict'
+# (zlib with a dictionary trained on the group's articles, so that
+# small entries compress well too).  May be overridden in group
+# config ("compression").  migrate.py recompresses groups.
+article_compression = None
+
+# the zlib compression level for article entries
+article_compress_level = 6
+
+# with 'zlib-dict' compression: the size of dictionaries (at most
+# 32K), the number of recent articles they are trained on, and the
+# number of articles a group needs before update.py trains one
+article_dictionary_size = 16 * 1024
+article_dictionary_samples = 200
+article_dictionary_min_articles = 20
+
+# the size at which a new segment file is started, with segment storage
+article_segment_size = 16 * 1024 * 1024
+
+# whether to save a wire-ready rendering of each article alongside its
+# entry when it is saved, so that the NNTP server can send it straight
+# from the file.  May be overridden in group config.  Renderings of
+# existing articles can be made with fixindex.py.
+article_spool = False
+
+# whether to save each parsed feed in its group directory, for
+# debugging.  May be overridden in group config.  Feeds that fail to
+# parse are always saved, compressed.
+feed_debug_dump = False
+
+# feed bodies larger than this many bytes are spooled to a temporary
+# file while they are downloaded, rather than held in memory
+feed_spool_max_memory = 1024 * 1024
+
 # user-agent string
 user_agent = "pnntprss/0.01 +http://david.wragg.org/pnntprss/"
 
 # how many feeds to retrieve concurrently when polling all feeds
 feed_poll_concurrency = 4
 
+# how many feeds on the same host to retrieve concurrently
+feed_poll_per_host_concurrency = 2
+
+# how long to leave a host alone after it says it is overloaded (with
+# a 429 or 503 response) without saying when to retry
+feed_throttle_backoff = 300
+
+# how often update.py --daemon looks for added and deleted groups
+daemon_rescan_interval = 60
+
+# how soon update.py --daemon tries again to poll a group that another
+# process (such as expire.py) has locked
+daemon_lock_retry_delay = 60
+
+# The NNTP server: the port it listens on, the length of its listen
+# backlog, and how it serves connections (see nntpserver.py)
+nntp_port = 4321
+nntp_listen_backlog = 128
+nntp_server_mode = 'fork'
+
+# the size of the worker pool in the prefork and thread modes
+nntp_workers = 16
+
+# the most connections served at once in fork mode
+nntp_max_connections = 100
+
+# the most connections served at once by nntpasync.py, and the number
+# of threads it uses to process commands
+nntp_async_max_connections = 5000
+nntp_executor_threads = 8
+
+# the zlib compression level for sessions using COMPRESS DEFLATE
+nntp_compress_level = 6
+
+# the memory budget, in bytes, for the groups and articles cached by
+# servers whose connections share a process
+nntp_cache_size = 64 * 1024 * 1024
+
 # Logging settings
 import logging
 
@@ -0,0 +1,625 @@
+# Article storage.
+#
+# The encoded entries of a group's articles are kept by a store,
+# chosen by the group's "storage" config value (settings.article_storage
+# by default):
+#
+#   files     each article in its own file in the group directory,
+#             named by its number
+#   segments  articles appended to a few large segment files, with an
+#             index giving the location of each
+#   sqlite    articles, the group index and the overview in an SQLite
+#             database in the group directory
+#
+# The files and segments stores keep the group index (mapping feed
+# entry ids to article numbers) and the overview in the index and
+# overview files of the group directory.
+#
+# All stores have the same methods, so that Group need not know which
+# it is using.  migrate.py converts groups from one store to another.
+
+import os, os.path, time, errno, mmap, struct, threading
+
+import settings, codec
+
+def isdigit(c):
+    """Return true if the given character is a digit."""
+    return c >= '0' and c <= '9'
+
+class GroupFiles:
+    """Keeps the group index and overview in files of the group
+    directory."""
+
+    def load_index(self):
+        """Return the group index, a dict mapping entry ids to article
+        numbers (or (number, fingerprint) pairs)."""
+        return self.group.load_value("index", {})
+
+    def save_index(self, index):
+        self.group.save_value("index", index)
+
+    def load_overview(self):
+        """Return the overview lines, in article number order, or None
+        if there is no overview."""
+        data = self.group.load("overview")
+        if data is None:
+            return None
+        return data.splitlines()
+
+    def save_overview(self, lines):
+        self.group.save("overview", ''.join(l + "\n" for l in lines))
+
+    def scan(self, lo=None, hi=None):
+        """Generate the (number, data) pairs of the articles numbered
+        from lo to hi inclusive (None meaning unbounded), in number
+        order, loading each only when it is reached."""
+        nums = sorted(num for num in self.numbers()
+                      if (lo is None or num >= lo)
+                      and (hi is None or num <= hi))
+        for num in nums:
+            data = self.load(num)
+            # it may have been deleted since
+            if data is not None:
+                yield (num, data)
+
+    def extent(self):
+        """Return the (lowest, highest, count) of the article numbers.
+        lowest and highest are None if there are no articles."""
+        nums = self.numbers()
+        if not nums:
+            return (None, None, 0)
+        return (min(nums), max(nums), len(nums))
+
+    def remove_metadata(self):
+        """Delete the group index and overview."""
+        self.group.saferemove("index")
+        self.group.saferemove("overview")
+
+class FileStore(GroupFiles):
+    """Stores each article in its own file, named by its number.  The
+    modification time of the file is the article's arrival time."""
+
+    name = 'files'
+
+    def __init__(self, group):
+        self.group = group
+
+    def load(self, num):
+        """Return the data of an article, or None if it does not
+        exist."""
+        return self.group.load(str(num))
+
+    def save(self, num, data, t=None):
+        """Save the data of an article, arriving at time t (by default,
+        now)."""
+        self.group.save(str(num), data)
+        if t is not None:
+            os.utime(self.group.group_file(str(num)), (t, t))
+
+    def delete(self, nums):
+        for num in nums:
+            self.group.saferemove(str(num))
+
+    def compact(self):
+        """Reclaim the space of deleted articles."""
+        pass
+
+    def numbers(self):
+        """Return the numbers of the articles, in no particular order."""
+        return [int(f) for f in os.listdir(self.group.path) if isdigit(f[0])]
+
+    def exists(self, num):
+        return os.path.exists(self.group.group_file(str(num)))
+
+    def time(self, num):
+        """Return the arrival time of an article, or None if it does
+        not exist."""
+        try:
+            return os.stat(self.group.group_file(str(num))).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def remove_all(self):
+        """Delete every article."""
+        self.delete(self.numbers())
+
+# An index record for the segment store: article number, segment
+# number, offset, length, and arrival time.
+record = struct.Struct('<IIIII')
+
+class SegmentStore(GroupFiles):
+    """Appends articles to segment files in the segments directory of
+    the group, named by number.  A new segment is started when the
+    last one reaches settings.article_segment_size.
+
+    The index file in the same directory holds a fixed-size record for
+    each article, sorted by article number, so that a lookup is a
+    binary search of the mapped index.  Replacing an article appends
+    its new data and rewrites its record in place; the old data, and
+    the data of deleted articles, is reclaimed by compact()."""
+
+    name = 'segments'
+
+    def __init__(self, group):
+        self.group = group
+
+    def path(self, name=None):
+        path = self.group.group_file("segments")
+        if name is not None:
+            path = os.path.join(path, str(name))
+        return path
+
+    def read_index(self):
+        """Return the contents of the index."""
+        try:
+            f = file(self.path("index"), "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return ''
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def records(self, data):
+        """Return the records in index data."""
+        return [record.unpack_from(data, pos)
+                for pos in xrange(0, len(data) - len(data) % record.size,
+                                  record.size)]
+
+    def write_index(self, records):
+        path = self.path("index")
+        tmppath = path + ".new"
+        f = file(tmppath, "wb")
+        try:
+            for rec in records:
+                f.write(record.pack(*rec))
+        finally:
+            f.close()
+
+        os.rename(tmppath, path)
+
+    def find(self, buf, num):
+        """Return the position in the index buffer of the record for
+        num, or of the first record for a greater number."""
+        lo = 0
+        hi = len(buf) // record.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record.unpack_from(buf, mid * record.size)[0] < num:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo * record.size
+
+    def lookup(self, num):
+        """Return the index record for an article, or None."""
+        try:
+            f = file(self.path("index"), "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < record.size:
+                return None
+
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                pos = self.find(m, num)
+                if pos + record.size > size:
+                    return None
+
+                rec = record.unpack_from(m, pos)
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+        if rec[0] != num:
+            return None
+
+        return rec
+
+    def load(self, num):
+        # compaction may remove a segment after we read the index, in
+        # which case the index will have been replaced: try again.
+        for attempt in (0, 1):
+            rec = self.lookup(num)
+            if rec is None:
+                return None
+
+            (num, seg, offset, length, t) = rec
+            try:
+                fd = os.open(self.path(seg), os.O_RDONLY)
+            except OSError as e:
+                if e.errno != errno.ENOENT or attempt:
+                    raise
+                continue
+
+            try:
+                # Python 2 has no os.pread
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, length)
+            finally:
+                os.close(fd)
+
+            return data
+
+    def scan(self, lo=None, hi=None):
+        # the index is in number order, so read the segments
+        # sequentially rather than looking up each article
+        buf = self.read_index()
+        pos = 0
+        if lo is not None:
+            pos = self.find(buf, lo)
+
+        f = None
+        seg = None
+        try:
+            for (num, s, offset, length, t) in self.records(buf[pos:]):
+                if hi is not None and num > hi:
+                    break
+
+                if s != seg:
+                    if f is not None:
+                        f.close()
+                        f = None
+                    seg = s
+                    try:
+                        f = file(self.path(seg), "rb")
+                    except IOError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+
+                if f is None:
+                    # compacted away since we read the index
+                    data = self.load(num)
+                    if data is None:
+                        continue
+                else:
+                    f.seek(offset)
+                    data = f.read(length)
+
+                yield (num, data)
+        finally:
+            if f is not None:
+                f.close()
+
+    def segments(self):
+        """Return the numbers of the segment files, in order."""
+        try:
+            names = os.listdir(self.path())
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        return sorted(int(n) for n in names if isdigit(n[0]))
+
+    def append(self, data):
+        """Append data to the last segment, or a new one if it is full.
+        Returns the segment number and offset."""
+        segs = self.segments()
+        if not segs:
+            if not os.path.isdir(self.path()):
+                os.mkdir(self.path())
+            seg = 1
+        else:
+            seg = segs[-1]
+
+        fd = os.open(self.path(seg), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0666)
+        try:
+            offset = os.fstat(fd).st_size
+            if offset and offset + len(data) > settings.article_segment_size:
+                os.close(fd)
+                seg += 1
+                fd = os.open(self.path(seg),
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+                offset = 0
+
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+        return (seg, offset)
+
+    def save(self, num, data, t=None):
+        if t is None:
+            t = time.time()
+
+        (seg, offset) = self.append(data)
+        self.put_record((num, seg, offset, len(data), int(t)))
+
+    def put_record(self, rec):
+        """Add or replace an index record."""
+        path = self.path("index")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            size = os.fstat(fd).st_size
+            size -= size % record.size
+            buf = ''
+            if size:
+                # new articles normally come last, so check that first
+                os.lseek(fd, size - record.size, os.SEEK_SET)
+                last = record.unpack(os.read(fd, record.size))
+                if last[0] >= rec[0]:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    buf = os.read(fd, size)
+
+            if not buf:
+                os.lseek(fd, size, os.SEEK_SET)
+                os.write(fd, record.pack(*rec))
+                return
+
+            pos = self.find(buf, rec[0])
+            if record.unpack_from(buf, pos)[0] == rec[0]:
+                os.lseek(fd, pos, os.SEEK_SET)
+                os.write(fd, record.pack(*rec))
+                return
+        finally:
+            os.close(fd)
+
+        # inserting in the middle means rewriting the index
+        self.write_index(sorted(self.records(buf) + [rec]))
+
+    def delete(self, nums):
+        nums = set(nums)
+        records = self.records(self.read_index())
+        self.write_index([rec for rec in records if rec[0] not in nums])
+
+    def compact(self):
+        """Move the live articles out of segments which are mostly
+        dead, and remove those segments.  The last segment, which is
+        still being appended to, is left alone."""
+        segs = self.segments()
+        if len(segs) < 2:
+            return
+
+        records = self.records(self.read_index())
+        live = {}
+        for rec in records:
+            live[rec[1]] = live.get(rec[1], 0) + rec[3]
+
+        sparse = set()
+        for seg in segs[:-1]:
+            if live.get(seg, 0) * 2 < os.path.getsize(self.path(seg)):
+                sparse.add(seg)
+
+        if not sparse:
+            return
+
+        res = []
+        for rec in records:
+            (num, seg, offset, length, t) = rec
+            if seg in sparse:
+                f = file(self.path(seg), "rb")
+                try:
+                    f.seek(offset)
+                    data = f.read(length)
+                finally:
+                    f.close()
+
+                (seg, offset) = self.append(data)
+                rec = (num, seg, offset, length, t)
+
+            res.append(rec)
+
+        self.write_index(res)
+        for seg in sparse:
+            os.remove(self.path(seg))
+
+    def numbers(self):
+        return [rec[0] for rec in self.records(self.read_index())]
+
+    def exists(self, num):
+        return self.lookup(num) is not None
+
+    def time(self, num):
+        rec = self.lookup(num)
+        if rec is None:
+            return None
+        return rec[4]
+
+    def remove_all(self):
+        path = self.path()
+        if os.path.isdir(path):
+            for f in os.listdir(path):
+                os.remove(os.path.join(path, f))
+            os.rmdir(path)
+
+class SqliteStore:
+    """Keeps articles, the group index and the overview in tables of
+    the articles.db SQLite database in the group directory.
+
+    The database is in WAL mode, so that servers can read it while
+    update.py and expire.py write.  SQLite connections cannot be
+    shared between threads, so each thread opens its own."""
+
+    name = 'sqlite'
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS articles (
+               num INTEGER PRIMARY KEY, time REAL NOT NULL,
+               data BLOB NOT NULL)""",
+        # also lets count(*) avoid reading the article data
+        """CREATE INDEX IF NOT EXISTS articles_time ON articles (time)""",
+        """CREATE TABLE IF NOT EXISTS ids (
+               id TEXT PRIMARY KEY, num INTEGER NOT NULL, fingerprint TEXT)""",
+        """CREATE TABLE IF NOT EXISTS overview (
+               num INTEGER PRIMARY KEY, line BLOB NOT NULL)""",
+        ]
+
+    def __init__(self, group):
+        self.group = group
+        self.local = threading.local()
+
+    def path(self):
+        return self.group.group_file("articles.db")
+
+    def db(self):
+        """Return this thread's connection to the database."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # imported here so that other stores work without it
+            import sqlite3
+            conn = sqlite3.connect(self.path(), timeout=60)
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode, this is still safe against corruption
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for stmt in self.schema:
+                conn.execute(stmt)
+            conn.commit()
+            self.local.conn = conn
+
+        return conn
+
+    def query(self, sql, *args):
+        return self.db().execute(sql, args).fetchall()
+
+    def update(self, sql, *args):
+        db = self.db()
+        db.execute(sql, args)
+        db.commit()
+
+    def load(self, num):
+        rows = self.query("SELECT data FROM articles WHERE num = ?", num)
+        if not rows:
+            return None
+        return str(rows[0][0])
+
+    def save(self, num, data, t=None):
+        if t is None:
+            t = time.time()
+        self.update("INSERT OR REPLACE INTO articles VALUES (?, ?, ?)",
+                    num, t, buffer(data))
+
+    def delete(self, nums):
+        db = self.db()
+        db.executemany("DELETE FROM articles WHERE num = ?",
+                       [(num,) for num in nums])
+        db.commit()
+
+    def compact(self):
+        # SQLite reuses the free pages
+        pass
+
+    def numbers(self):
+        return [row[0] for row in self.query("SELECT num FROM articles")]
+
+    def scan(self, lo=None, hi=None):
+        (where, args) = self.range_condition(lo, hi)
+        cursor = self.db().execute("SELECT num, data FROM articles"
+                                   + where + " ORDER BY num", args)
+        # rows are fetched as the cursor is iterated
+        for (num, data) in cursor:
+            yield (num, str(data))
+
+    def range_condition(self, lo, hi):
+        """Return a WHERE clause selecting article numbers from lo to
+        hi inclusive, and its arguments."""
+        where = " WHERE 1"
+        args = []
+        if lo is not None:
+            where += " AND num >= ?"
+            args.append(lo)
+        if hi is not None:
+            where += " AND num <= ?"
+            args.append(hi)
+
+        return (where, args)
+
+    def extent(self):
+        return self.query("SELECT min(num), max(num), count(*) "
+                          "FROM articles")[0]
+
+    def exists(self, num):
+        return bool(self.query("SELECT 1 FROM articles WHERE num = ?", num))
+
+    def time(self, num):
+        rows = self.query("SELECT time FROM articles WHERE num = ?", num)
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def load_index(self):
+        index = {}
+        for (id, num, fingerprint) in self.query("SELECT * FROM ids"):
+            if fingerprint is None:
+                index[id] = num
+            else:
+                index[id] = (num, fingerprint)
+
+        return index
+
+    def save_index(self, index):
+        rows = []
+        for (id, val) in index.iteritems():
+            if isinstance(val, tuple):
+                rows.append((id, val[0], val[1]))
+            else:
+                rows.append((id, val, None))
+
+        db = self.db()
+        db.execute("DELETE FROM ids")
+        db.executemany("INSERT INTO ids VALUES (?, ?, ?)", rows)
+        db.commit()
+        # active.py uses the modification time of the index as the
+        # stamp of the group's state
+        self.group.save("stamp", "")
+
+    def load_overview(self):
+        rows = self.query("SELECT line FROM overview ORDER BY num")
+        if not rows:
+            return None
+        return [str(row[0]) for row in rows]
+
+    def overview_lines(self, lo=None, hi=None):
+        """Generate the overview lines for articles numbered from lo
+        to hi, inclusive.  None means unbounded."""
+        (where, args) = self.range_condition(lo, hi)
+        cursor = self.db().execute("SELECT line FROM overview"
+                                   + where + " ORDER BY num", args)
+        for (line,) in cursor:
+            yield str(line)
+
+    def save_overview(self, lines):
+        db = self.db()
+        db.execute("DELETE FROM overview")
+        db.executemany("INSERT INTO overview VALUES (?, ?)",
+                       [(int(l[:l.index("\t")]), buffer(l)) for l in lines])
+        db.commit()
+
+    def remove_all(self):
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            self.group.saferemove("articles.db" + suffix)
+        self.group.saferemove("stamp")
+
+    def remove_metadata(self):
+        db = self.db()
+        db.execute("DELETE FROM ids")
+        db.execute("DELETE FROM overview")
+        db.commit()
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+stores = dict((s.name, s) for s in [FileStore, SegmentStore, SqliteStore])
+
+def store_for(group):
+    """Return the store for a group's articles."""
+    return stores[group.config.get("storage", settings.article_storage)](group)
@@ -10,13 +10,17 @@
 # When run with no arguments, polls all feeds that should be checked.
 # Otherwise, polls the feeds specfiied by the group names given as
 # arguments.
+#
+# Alternatively, when run with --daemon, it keeps running and polls
+# each feed when it is due, from a pool of worker threads.
 
 import sys, time, hashlib, os, socket, traceback, resource, urllib2, urllib
-import logging
+import logging, optparse, heapq, threading, signal, Queue, gzip
 from cStringIO import StringIO
 import feedparser
 
-import settings, lockfile, group
+import settings, lockfile, group, overview, active, fetch, codec, msgid
+import arrivals
 
 # use a socket timeout of 20 seconds
 socket.setdefaulttimeout(20)
@@ -47,6 +51,17 @@ def stable_repr(val):
     else:
         return repr(val)
 
+def entry_fingerprint(entry):
+    """Return a hash of the content of an entry, which changes when
+    the entry is updated.
+
+    Like Article.same_entry, this ignores feed_updated_parsed."""
+    # feedparser's dict subclasses need to become plain dicts for
+    # stable_repr to order their keys
+    entry = codec.plain(entry)
+    entry.pop('feed_updated_parsed', None)
+    return hashlib.md5(stable_repr(entry)).hexdigest()
+
 def transform(v, f):
     v = f(v)
     if isinstance(v, dict):
@@ -70,12 +85,20 @@ def fix_unicode_keys(d):
 
     return d
 
+# Measure CPU time per thread where we can, as the daemon polls feeds
+# in several threads.
+if sys.platform.startswith('linux'):
+    rusage_who = getattr(resource, 'RUSAGE_THREAD', 1)
+else:
+    rusage_who = resource.RUSAGE_SELF
+
 def cputime():
-    ru = resource.getrusage(resource.RUSAGE_SELF)
+    ru = resource.getrusage(rusage_who)
     return ru.ru_utime + ru.ru_stime
 
 class UnchangedHandler(urllib2.BaseHandler):
-    def __init__(self, expected_md5):
+    def __init__(self, name, expected_md5):
+        self.name = name
         self.expected_md5 = expected_md5
         self.actual_md5 = None
 
@@ -83,8 +106,8 @@ class UnchangedHandler(urllib2.BaseHandler):
         if resp.getcode() != 200:
             return resp
 
-        body = resp.read()
-        self.actual_md5 = hashlib.md5(body).hexdigest()
+        (body, self.actual_md5) = fetch.spool(resp.read)
+        resp.close()
 
         code = resp.getcode()
         msg = ""
@@ -93,22 +116,63 @@ class UnchangedHandler(urllib2.BaseHandler):
             msg = resp.msg
 
         if self.actual_md5 == self.expected_md5:
-            logger.debug("%s matched existing md5sum" % (g.name,))
+            logger.debug("%s matched existing md5sum" % (self.name,))
             code = 304
             msg = "Not modified"
+            body.close()
+            body = StringIO('')
 
-        resp = urllib.addinfourl(StringIO(body), resp.info(), resp.geturl(),
-                                 code)
+        resp = urllib.addinfourl(body, resp.info(), resp.geturl(), code)
         resp.msg = msg
         return resp
 
     https_response = http_response
 
+def fetch_feed(g):
+    """Fetch and parse the feed of a group.
+
+    Returns the parsed feed, and the md5sum of its body if we got
+    one.  If the body is unchanged since the last poll, the feed is
+    not parsed, and appears as if the server said it was not
+    modified."""
+    href = g.config['href']
+    state = restrict(g.config, state_keys)
+    expected_md5 = g.config.get("md5sum", "")
+
+    if not fetch.handles(href):
+        handler = UnchangedHandler(g.name, expected_md5)
+        feed = feedparser.parse(href, agent=settings.user_agent,
+                                handlers=[handler], **state)
+        if feed.get('status') in fetch.throttled_codes:
+            headers = dict((k.lower(), v)
+                           for (k, v) in feed.get('headers', {}).items())
+            raise fetch.ThrottledError(fetch.feed_host(href),
+                          fetch.parse_retry_after(headers.get('retry-after')))
+
+        return (feed, handler.actual_md5)
+
+    resp = fetch.fetch(href, agent=settings.user_agent, **state)
+    if resp.getcode() in fetch.throttled_codes:
+        raise fetch.ThrottledError(fetch.feed_host(href),
+                   fetch.parse_retry_after(resp.headers.get('retry-after')))
+
+    md5 = None
+    if resp.getcode() == 200:
+        md5 = resp.md5
+        if md5 == expected_md5:
+            logger.debug("%s matched existing md5sum" % (g.name,))
+            resp = fetch.not_modified(resp)
+
+    return (feedparser.parse(resp), md5)
+
 def update(g):
+    """Poll the feed of a group, and save any new or updated articles.
+    Returns False if the group was locked, so that it was not
+    polled."""
     if not g.lockfile.trylock():
         # we are already updating, expiring, or otherwise messing with
         # this group.  No problem, we'll try again next time round.
-        return
+        return False
 
     try:
         logger.debug("Checking " + g.name)
@@ -118,21 +182,18 @@ def update(g):
 
         startt = cputime()
         try:
-            handler = UnchangedHandler(g.config.get("md5sum", ""))
-            update_group_from_feed(g,
-                            feedparser.parse(g.config['href'],
-                                             agent=settings.user_agent,
-                                             handlers=[handler],
-                                             **restrict(g.config, state_keys)))
+            (feed, md5) = fetch_feed(g)
+            update_group_from_feed(g, feed)
 
-            if handler.actual_md5:
-                g.config["md5sum"] = handler.actual_md5
+            if md5:
+                g.config["md5sum"] = md5
 
             for k in ("last_failed_poll", "failed_polls"):
                 if k in g.config:
                     del g.config[k]
 
             g.save_config()
+            active.update(g)
         except:
             g.config["last_failed_poll"] = time.time()
             g.config["failed_polls"] = g.config.get("failed_polls", 0) + 1
@@ -145,9 +206,25 @@ def update(g):
     finally:
         g.lockfile.unlock()
 
+    return True
+
+def dump_feed(g, feed, compressed=False):
+    """Save a parsed feed in the group's directory, for debugging."""
+    if compressed:
+        buf = StringIO()
+        f = gzip.GzipFile("feed", "wb", fileobj=buf)
+        f.write(repr(feed))
+        f.close()
+        g.save("feed.gz", buf.getvalue())
+    else:
+        g.save("feed", repr(feed))
+
 def update_group_from_feed(g, feed):
     # for debugging
-    g.save("feed", repr(feed))
+    if g.config.get("debug_dump", settings.feed_debug_dump):
+        dump_feed(g, feed)
+    elif feed.bozo:
+        dump_feed(g, feed, compressed=True)
 
     if feed.bozo:
         if feed.get('status'):
@@ -179,11 +256,18 @@ def update_group_from_feed(g, feed):
                                 or time.gmtime(now))
 
     if 'entries' in feed and len(feed['entries']):
-        index = g.load_eval("index", {})
+        index = g.load_index()
 
         # XXX might need to generate index if it didn't exist
         g.saferemove("index")
 
+        # new and updated articles, for the overview
+        saved = []
+        arrived = False
+
+        # message-ids of articles given new numbers
+        numbered = {}
+
         # entries are in reverse chronological order.  But we want
         # chronological order, to match article numbers
         for entry in reversed(feed.entries):
@@ -209,13 +293,24 @@ def update_group_from_feed(g, feed):
             # Normalize the id
             id = hashlib.md5(id.encode('utf-8')).hexdigest()
             entry['message_id'] = id
-            num = index.get(id)
+            fingerprint = entry_fingerprint(entry)
+            indexed = index.get(id)
+            num = group.index_number(indexed)
             action = "New"
 
-            if num is not None:
+            if isinstance(indexed, tuple):
+                # the fingerprint tells us whether the entry changed,
+                # without reading the article
+                if indexed[1] == fingerprint:
+                    continue
+
+                action = "Updated"
+            elif num is not None:
                 a = g.article(num)
                 if a is not None:
                     if a.same_entry(entry):
+                        # record the fingerprint for next time
+                        index[id] = (num, fingerprint)
                         continue
 
                     action = "Updated"
@@ -223,7 +318,11 @@ def update_group_from_feed(g, feed):
                     num = None
 
             if num is None:
-                num = index[id] = g.next_article_number()
+                num = g.next_article_number()
+                numbered[group.message_id(id, g.name)] = num
+                arrived = True
+
+            index[id] = (num, fingerprint)
 
             # some feeds lack a updated time on entries, but we need
             # it for the date header.  Add a feed_updated_parsed value here.
@@ -232,17 +331,46 @@ def update_group_from_feed(g, feed):
             logger.info("%s article %s@%s (%s)"
                         % (action, id, g.name, num))
             g.save_article(num, entry)
+            saved.append(group.Article(g, num, entry))
 
         # XXX need to catch exceptions so we always save next art number
-        g.save("index", repr(index))
-
-def run_tasks(tasks, concurrency):
+        g.save_index(index)
+        msgid.add(g.name, numbered)
+        arrivals.log_articles(g.name, numbered)
+
+        if saved:
+            ov = overview.load(g)
+            for art in saved:
+                ov.set(art.number(), overview.overview_line(art))
+            overview.save(g, ov)
+
+        # entries saved before the group had a dictionary stay
+        # compressed without one, until migrate.py rewrites them
+        if (saved and g.compression() == 'zlib-dict'
+            and g.config.get("dictionary") is None
+            and (g.article_range()[2]
+                 >= settings.article_dictionary_min_articles)):
+            logger.info("Training compression dictionary for " + g.name)
+            g.train_dictionary()
+
+        if arrived:
+            g.record_arrival(now)
+
+    if g.adaptive():
+        g.learn_poll_interval(now)
+
+def run_tasks(tasks, concurrency, per_host_concurrency):
+    """Run tasks, given as (host, argv) pairs, as child processes.  At
+    most concurrency run at once, and at most per_host_concurrency
+    for the same host."""
     pids = {}
+    busy = {}
 
     def reap_one():
         (pid, status) = os.waitpid(-1, 0)
         if pid in pids:
-            task = pids.pop(pid)
+            (host, task) = pids.pop(pid)
+            busy[host] -= 1
             if os.WIFEXITED(status):
                 res = os.WEXITSTATUS(status)
                 if res != 0:
@@ -251,33 +379,225 @@ def run_tasks(tasks, concurrency):
                 logger.info("exit with signal %s: %s" % (os.WTERMSIG(status),
                                                          task))
 
-    for task in tasks:
+    def runnable(host):
+        return host is None or busy.get(host, 0) < per_host_concurrency
+
+    tasks = iter(tasks)
+    # tasks set aside while their host was busy
+    deferred = []
+
+    while True:
+        chosen = None
+        for (i, (host, task)) in enumerate(deferred):
+            if runnable(host):
+                chosen = deferred.pop(i)
+                break
+        else:
+            for (host, task) in tasks:
+                if runnable(host):
+                    chosen = (host, task)
+                    break
+
+                deferred.append((host, task))
+
+        if chosen is None:
+            if not pids:
+                break
+
+            reap_one()
+            continue
+
         while len(pids) >= concurrency:
             reap_one()
-        
+
+        (host, task) = chosen
         pid = os.spawnvp(os.P_NOWAIT, task[0], task)
-        pids[pid] = task
+        pids[pid] = chosen
+        busy[host] = busy.get(host, 0) + 1
+
+def log_failure(name, e):
+    if logger.isEnabledFor(logging.DEBUG):
+        msg = traceback.format_exc()
+    else:
+        msg = str(e)
+
+    logger.warning("%s: %s" % (name, msg))
+
+class Scheduler:
+    """Polls feeds when they are due, from a pool of worker threads.
+
+    Groups are held in a priority queue ordered by next poll time, so
+    configs are only reloaded when a group is polled.
+
+    At most per_host_concurrency feeds from the same host are polled
+    at once.  Due feeds from a busy host are set aside until one of
+    its polls finishes, leaving the workers free for other hosts.
+    When a host responds with 429 or 503, its feeds are put back in
+    the queue until it is willing to talk to us again."""
+
+    def __init__(self, concurrency, per_host_concurrency):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.cond = threading.Condition()
+        # heap of (next poll time, group name)
+        self.queue = []
+        self.groups = {}
+        self.tasks = Queue.Queue()
+        self.next_rescan = 0
+        # number of polls in progress, in total and per host
+        self.in_flight = 0
+        self.busy = {}
+        # due (time, name) pairs set aside while their host is busy
+        self.waiting = {}
+        # host -> time before which we should leave it alone
+        self.backoff = {}
+
+    def schedule(self, g, t=None):
+        """Queue a group to be polled when it is due, or at time t.
+
+        The caller should hold self.cond."""
+        if t is None:
+            t = g.next_poll_time()
+        heapq.heappush(self.queue, (t, g.name))
+        self.cond.notify()
+
+    def rescan(self):
+        """Pick up groups that have been added or deleted."""
+        names = set(group.group_names())
+        with self.cond:
+            for name in list(self.groups):
+                if name not in names:
+                    del self.groups[name]
+
+            for name in names:
+                if name not in self.groups:
+                    try:
+                        g = group.Group(name)
+                    except group.NoSuchGroupError:
+                        continue
 
-    while pids:
-        reap_one()
+                    self.groups[name] = g
+                    self.schedule(g)
+
+        self.next_rescan = time.time() + settings.daemon_rescan_interval
+
+    def worker(self):
+        while True:
+            (g, host) = self.tasks.get()
+            throttled = None
+            locked = False
+            try:
+                locked = not update(g)
+            except fetch.ThrottledError as e:
+                throttled = e
+                log_failure(g.name, e)
+            except Exception as e:
+                log_failure(g.name, e)
+
+            with self.cond:
+                self.in_flight -= 1
+                self.busy[host] -= 1
+                for item in self.waiting.pop(host, []):
+                    heapq.heappush(self.queue, item)
+
+                if throttled:
+                    delay = throttled.retry_after
+                    if delay is None:
+                        delay = settings.feed_throttle_backoff
+                    self.backoff[host] = time.time() + delay
+
+                # if the group was deleted meanwhile, forget it
+                if self.groups.get(g.name) is g:
+                    if locked:
+                        # it is still due, but leave whoever holds
+                        # the lock to finish
+                        self.schedule(g, time.time()
+                                      + settings.daemon_lock_retry_delay)
+                    else:
+                        self.schedule(g)
+                else:
+                    self.cond.notify()
+
+    def dispatch(self, now):
+        """Hand due groups to the workers, as far as the concurrency
+        limits allow.
+
+        The caller should hold self.cond."""
+        while (self.in_flight < self.concurrency and self.queue
+               and self.queue[0][0] <= now):
+            item = heapq.heappop(self.queue)
+            g = self.groups.get(item[1])
+            if g is None:
+                continue
+
+            host = fetch.feed_host(g.config.get('href', ''))
+            if host is not None:
+                until = self.backoff.get(host, 0)
+                if until > now:
+                    heapq.heappush(self.queue, (until, item[1]))
+                    continue
+
+                if self.busy.get(host, 0) >= self.per_host_concurrency:
+                    self.waiting.setdefault(host, []).append(item)
+                    continue
+
+            self.in_flight += 1
+            self.busy[host] = self.busy.get(host, 0) + 1
+            self.tasks.put((g, host))
+
+    def run(self, lock):
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+        while True:
+            if time.time() >= self.next_rescan:
+                self.rescan()
+                if not lock.touch():
+                    logger.warning("update lock was snatched; exiting")
+                    return
+
+            with self.cond:
+                now = time.time()
+                self.dispatch(now)
+
+                wakeup = self.next_rescan
+                if self.queue and self.in_flight < self.concurrency:
+                    wakeup = min(wakeup, self.queue[0][0])
+
+                self.cond.wait(max(wakeup - now, 0))
+
+def sigterm(signum, frame):
+    # make sure the update lock gets released
+    sys.exit(0)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        for arg in sys.argv[1:]:
+    parser = optparse.OptionParser(usage="%prog [--daemon] [group...]")
+    parser.add_option('-d', '--daemon', action='store_true',
+                      help="keep running, polling feeds when they are due")
+    (opts, args) = parser.parse_args()
+
+    if args:
+        for arg in args:
             try:
                 g = group.Group(arg)
                 if g.ready_to_check(time.time()):
                     update(g)
             except Exception as e:
-                if logger.isEnabledFor(logging.DEBUG):
-                    msg = traceback.format_exc()
-                else:
-                    msg = str(e)
-
-                logger.warning("%s: %s" % (arg, msg))
+                log_failure(arg, e)
     else:
         lock = lockfile.LockFile(os.path.join(settings.groups_dir, "update.lock"))
-        if lock.trylock():
+        if opts.daemon:
+            signal.signal(signal.SIGTERM, sigterm)
+            # wait for any cron-driven run to finish
+            lock.lock()
+            try:
+                Scheduler(settings.feed_poll_concurrency,
+                          settings.feed_poll_per_host_concurrency).run(lock)
+            finally:
+                lock.unlock()
+        elif lock.trylock():
             try:
                 def touching(l, it):
                     for x in it:
@@ -286,9 +606,12 @@ if __name__ == "__main__":
                             return
             
                 now = time.time()
-                run_tasks(touching(lock,((sys.argv[0], g.name)
-                                         for g in group.groups()
-                                         if g.ready_to_check(now))),
-                          settings.feed_poll_concurrency)
+                run_tasks(touching(lock,
+                                   ((fetch.feed_host(g.config['href']),
+                                     (sys.argv[0], g.name))
+                                    for g in group.groups()
+                                    if g.ready_to_check(now))),
+                          settings.feed_poll_concurrency,
+                          settings.feed_poll_per_host_concurrency)
             finally:
                 lock.unlock()